@@ -18,31 +18,95 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-from homsearch_interface import HomsearchInterface
+import os
+import math
+import random
+import asyncio
+import pickle
+import struct
+import hashlib
+import statistics
+import collections
+import concurrent.futures
+
+
+import numpy
+
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+from homsearch_interface import HomsearchInterface, adjacency_to_csr
 
 #############################
 # Auxiliary conversion utils
 
-def graph_to_adjlist(G):
-    "Takes a graph and returns a numeric adjacency list"
+def is_array_graph(G):
+    """
+    Is `G` given as an adjacency array rather than a Sage or NetworkX graph?
+    That is a CSR pair `(indptr, indices)` (any tuple, as in `adjacency_to_csr`), a SciPy sparse matrix
+    or a dense NumPy matrix, the vertices are then 0 .. n-1.
+    """
+
+    return isinstance(G, (tuple, numpy.ndarray)) or hasattr(G, 'tocsr')
+
+
+def graph_vertices(G):
+    "Takes a graph and returns the list of its vertices, in the order used for numbering"
+
+    if is_array_graph(G):
+        n = (len(G[0]) - 1) if isinstance(G, tuple) else G.shape[0]
+        return list(range(n))
 
     # Work for Sage and NetworkX
     try:
-        Gvs = G.vertices()
+        return list(G.vertices())
     except AttributeError:
-        Gvs = G.nodes()
+        return list(G.nodes())
 
-    map_numbers = {}
-    for vi in range(G.order()):
-        v = Gvs[vi]
-        map_numbers[v] = vi
 
-    adj_list = []
-    for vi in range(G.order()):
-        v = Gvs[vi]
-        adj_list.append([map_numbers[u] for u in G.neighbors(v)])
+def edges_to_csr(n, src, dst):
+    "Takes edge endpoint arrays on vertices 0 .. n-1 and returns sorted, deduplicated CSR adjacency `(indptr, indices)`"
 
-    return adj_list
+    keys = numpy.unique(numpy.asarray(src, dtype=numpy.int64) * n + numpy.asarray(dst, dtype=numpy.int64))
+    indptr = numpy.zeros(n + 1, dtype=numpy.intc)
+    numpy.cumsum(numpy.bincount(keys // n, minlength=n), out=indptr[1:])
+    return (indptr, numpy.ascontiguousarray(keys % n, dtype=numpy.intc))
+
+
+def graph_to_csr(G):
+    """
+    Takes a graph and returns its numeric CSR adjacency `(indptr, indices)` as int32 arrays
+    (out-neighbors for directed graphs).
+    Makes a single pass over the edges of Sage and NetworkX graphs, adjacency arrays are only normalized.
+    """
+
+    if is_array_graph(G):
+        return adjacency_to_csr(G)
+
+    Gvs = graph_vertices(G)
+    n = len(Gvs)
+    map_numbers = dict(zip(Gvs, range(n)))
+
+    # Work for Sage and NetworkX
+    try:
+        edges = G.edges(labels=False)
+    except TypeError:
+        edges = G.edges()
+
+    ends = numpy.fromiter((map_numbers[v] for e in edges for v in e[:2]), dtype=numpy.int64)
+    src, dst = ends[0::2], ends[1::2]
+    if G.is_directed():
+        return edges_to_csr(n, src, dst)
+    return edges_to_csr(n, numpy.concatenate((src, dst)), numpy.concatenate((dst, src)))
+
+
+def graph_to_adjlist(G):
+    "Takes a graph and returns a numeric adjacency list"
+
+    indptr, indices = graph_to_csr(G)
+    return [indices[indptr[v]:indptr[v + 1]].tolist() for v in range(len(indptr) - 1)]
 
 
 def fmap_to_graphmap(G, H, f):
@@ -51,15 +115,8 @@ def fmap_to_graphmap(G, H, f):
     Vertices assigned -1 are given None
     """
 
-    # Work for Sage and NetworkX
-    try:
-        Gvs = G.vertices()
-    except AttributeError:
-        Gvs = G.nodes()
-    try:
-        Hvs = H.vertices()
-    except AttributeError:
-        Hvs = H.nodes()
+    Gvs = graph_vertices(G)
+    Hvs = graph_vertices(H)
 
     gf = {}
     for v in range(len(f)):
@@ -77,18 +134,11 @@ def graphmap_to_fmap(G, H, gf):
     Undefined vertices and vertices mapped to None are assigned -1.
     """
 
-    # Work for Sage and NetworkX
-    try:
-        Gvs = G.vertices()
-    except AttributeError:
-        Gvs = G.nodes()
-    try:
-        Hvs = H.vertices()
-    except AttributeError:
-        Hvs = H.nodes()
+    Gvs = graph_vertices(G)
+    Hvs = graph_vertices(H)
 
     H_map_numbers = {}
-    for vi in range(H.order()):
+    for vi in range(len(Hvs)):
         v = Hvs[vi]
         H_map_numbers[v] = vi
 
@@ -102,51 +152,913 @@ def graphmap_to_fmap(G, H, gf):
     return f
 
 
-######################################
-# Main interface to running homsearch
+def lists_to_mask(G, H, lists):
+    """
+    Takes source and target graphs and candidate lists, either a dict `{G-vertex: iterable of H-vertices}`
+    (vertices not in the dict are unrestricted) or a |G| x |H| boolean matrix, returns the boolean matrix.
+    """
+
+    Hvs = graph_vertices(H)
+    if not isinstance(lists, dict):
+        mask = numpy.asarray(lists, dtype=bool)
+        assert mask.shape == (len(graph_vertices(G)), len(Hvs))
+        return mask
+
+    H_map_numbers = dict(zip(Hvs, range(len(Hvs))))
+    Gvs = graph_vertices(G)
+    mask = numpy.ones((len(Gvs), len(Hvs)), dtype=bool)
+    for vi in range(len(Gvs)):
+        if Gvs[vi] in lists:
+            mask[vi, :] = False
+            mask[vi, [H_map_numbers[u] for u in lists[Gvs[vi]]]] = True
+    return mask
 
-def find_homomorphisms(G, H, results_limit=-1, only_count=False, max_depth=-1, partmap=None):
+
+#########################################
+# Disk-backed result files
+#
+# File layout (native byte order):
+#   magic (8 bytes), row width in bytes (uint32), row length = |G| (uint32),
+#   label block length (uint32), pickled (G vertices, H vertices) label block,
+#   zero padding to a multiple of 8 bytes, rows of `width`-byte ints (-1 for unmapped).
+
+RESULTS_MAGIC = b'HOMSRES1'
+_RESULTS_HEAD = struct.Struct('=8sIII')
+
+def _results_file_width(H):
+    "Row integer width (bytes) sufficient for vertex numbers of `H`"
+    return 2 if len(graph_vertices(H)) < 2 ** 15 else 4
+
+
+def _write_results_header(path, G, H, width):
+    "Create (truncate) the result file `path` and write its header"
+
+    Gvs = graph_vertices(G)
+    labels = pickle.dumps((Gvs, graph_vertices(H)), protocol=2)
+    head = _RESULTS_HEAD.pack(RESULTS_MAGIC, width, len(Gvs), len(labels)) + labels
+    with open(path, 'wb') as f:
+        f.write(head)
+        f.write(b'\0' * (-len(head) % 8))
+
+
+def load_results(path):
     """
-    Run G->H homomorphism search on undirected graphs `G` and `H`, return list of maps or their number (acc. to `only_count`),
-    starting with `partmap` G-H-map if given.
+    Open a result file written with `results_file=path`, returns `(G_vertices, H_vertices, maps)`
+    where `maps` is a read-only memory-mapped NumPy array with one numeric map per row
+    (use `fmap_to_graphmap` or the vertex lists to translate rows).
     """
 
-    assert not G.is_directed()
-    assert not H.is_directed()
+    with open(path, 'rb') as f:
+        magic, width, ncols, labels_len = _RESULTS_HEAD.unpack(f.read(_RESULTS_HEAD.size))
+        if magic != RESULTS_MAGIC:
+            raise ValueError("%r is not a homsearch result file" % (path, ))
+        Gvs, Hvs = pickle.loads(f.read(labels_len))
 
-    hs = HomsearchInterface(graph_to_adjlist(G), graph_to_adjlist(H),
-            results_limit, (not only_count), False, max_depth=max_depth)
+    offset = _RESULTS_HEAD.size + labels_len
+    offset += -offset % 8
+    dtype = numpy.dtype(numpy.int16 if width == 2 else numpy.int32)
+    size = os.path.getsize(path) - offset
+    if (size < 0) or ((ncols > 0) and (size % (width * ncols) != 0)) or ((ncols == 0) and (size != 0)):
+        raise ValueError("%r is truncated (not a whole number of rows)" % (path, ))
+    rows = size // (width * ncols) if ncols > 0 else 0
+
+    if rows == 0:
+        return (Gvs, Hvs, numpy.empty((0, ncols), dtype=dtype))
+    maps = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(rows, ncols))
+    return (Gvs, Hvs, maps)
 
-    if partmap is None:
-        hs.search()
-    else:
-        hs.search_from(graphmap_to_fmap(G, H, partmap))
 
-    if only_count:
+#########################################
+# Persistent result cache
+
+def canonical_numbering(G):
+    """
+    Takes a graph and returns a list `p` with `p[i]` the canonical number of the `i`-th vertex.
+    Uses the canonical labelling of Sage graphs, falls back to the plain vertex order otherwise
+    (then only identically ordered graphs share the canonical form).
+    """
+
+    Gvs = graph_vertices(G)
+    try:
+        _canon, cert = G.canonical_label(certificate=True)
+    except AttributeError:
+        return list(range(len(Gvs)))
+    return [int(cert[v]) for v in Gvs]
+
+
+def _canonical_adjlist(adj, p):
+    "Renumber adjacency list `adj` by `p` (as from `canonical_numbering`)"
+
+    cadj = [None] * len(adj)
+    for v in range(len(adj)):
+        cadj[p[v]] = sorted(p[u] for u in adj[v])
+    return cadj
+
+
+class HomsearchCache(object):
+    """
+    Persistent on-disk cache of `find_homomorphisms` and `find_retracts` results,
+    pass as `cache=` to these functions.
+
+    Queries are keyed by a SHA-256 hash of the canonical forms of G and H and the search options,
+    results are stored in canonical numbering and relabelled to the vertices of the queried graphs.
+    The directory `path` is kept under `max_bytes` by evicting the least recently used entries.
+    """
+
+    def __init__(self, path, max_bytes=2 ** 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _fname(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def get(self, key):
+        "Return the value stored under `key` (marking it as recently used) or None"
+
+        fname = self._fname(key)
+        try:
+            with open(fname, 'rb') as f:
+                val = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(fname, None)
+        return val
+
+    def put(self, key, val):
+        "Store `val` under `key` and evict old entries over `max_bytes`"
+
+        fname = self._fname(key)
+        tmpname = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmpname, 'wb') as f:
+            pickle.dump(val, f, protocol=2)
+        os.rename(tmpname, fname)
+        self.evict()
+
+    def evict(self):
+        "Remove least recently used entries until the cache fits into `max_bytes`"
+
+        entries = []
+        for n in os.listdir(self.path):
+            if n.endswith('.pickle'):
+                st = os.stat(os.path.join(self.path, n))
+                entries.append((st.st_mtime, st.st_size, n))
+        total = sum(e[1] for e in entries)
+        for mtime, size, n in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, n))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        "Remove all entries"
+
+        for n in os.listdir(self.path):
+            if n.endswith('.pickle'):
+                os.remove(os.path.join(self.path, n))
+
+    def query(self, G, H, retract_mode, results_limit, only_count, max_depth, partmap,
+              distinct_images=False, minimal_images=False, lists=None, value_order='index', value_seed=None):
+        """
+        Answer a `find_homomorphisms` (or `find_retracts` with `retract_mode`) query from the cache,
+        running and storing the search on a miss.
+        """
+
+        pG = canonical_numbering(G)
+        pH = pG if retract_mode else canonical_numbering(H)
+        cpart = []
+        if partmap is not None:
+            cpart = sorted((pG[i], pH[fi]) for i, fi in enumerate(graphmap_to_fmap(G, H, partmap)) if fi >= 0)
+        clists = None
+        if lists is not None:
+            cmask = numpy.zeros((len(pG), len(pH)), dtype=bool)
+            cmask[numpy.ix_(pG, pH)] = lists_to_mask(G, H, lists)
+            clists = hashlib.sha256(numpy.packbits(cmask).tobytes()).hexdigest()
+
+        def make_key(counting):
+            desc = (1, retract_mode, _canonical_adjlist(graph_to_adjlist(G), pG),
+                    None if retract_mode else _canonical_adjlist(graph_to_adjlist(H), pH),
+                    results_limit, counting, max_depth, cpart)
+            if distinct_images or minimal_images:
+                desc += (distinct_images, minimal_images)
+            if clists is not None:
+                desc += (clists, )
+            if value_order != 'index' or value_seed is not None:
+                desc += (value_order, value_seed)
+            return hashlib.sha256(repr(desc).encode('ascii')).hexdigest()
+
+        # Enumerations also answer counting queries
+        key = make_key(False)
+        val = self.get(key)
+        if val is None and only_count:
+            key = make_key(True)
+            val = self.get(key)
+
+        if val is None:
+            if retract_mode:
+                res = find_retracts(G, results_limit, only_count, max_depth, partmap, lists=lists,
+                                    distinct_images=distinct_images, minimal_images=minimal_images,
+                                    value_order=value_order, value_seed=value_seed)
+            else:
+                res = find_homomorphisms(G, H, results_limit, only_count, max_depth, partmap, lists=lists,
+                                         value_order=value_order, value_seed=value_seed)
+            if only_count:
+                val = {'count': res, 'maps': None}
+            else:
+                maps = []
+                for gf in res:
+                    f = graphmap_to_fmap(G, H, gf)
+                    cf = [-1] * len(f)
+                    for i in range(len(f)):
+                        if f[i] >= 0:
+                            cf[pG[i]] = pH[f[i]]
+                    maps.append(cf)
+                val = {'count': len(maps), 'maps': maps}
+            self.put(key, val)
+
+        if only_count:
+            return val['count']
+
+        # Relabel from canonical numbering
+        pH_inv = [None] * len(pH)
+        for i in range(len(pH)):
+            pH_inv[pH[i]] = i
+        res = []
+        for cf in val['maps']:
+            f = [(pH_inv[cf[pG[i]]] if cf[pG[i]] >= 0 else -1) for i in range(len(pG))]
+            res.append(fmap_to_graphmap(G, H, f))
+        return res
+
+
+######################################
+# Main interface to running homsearch
+
+def _run_search(hs, G, H, only_count, partmap, results_file):
+    "Run the search on prepared `hs`, collect the results acc. to `only_count` and `results_file`"
+
+    if results_file is not None:
+        width = _results_file_width(H)
+        _write_results_header(results_file, G, H, width)
+        hs.open_results_file(results_file, width)
+
+    try:
+        if partmap is None:
+            hs.search()
+        else:
+            hs.search_from(graphmap_to_fmap(G, H, partmap))
+    finally:
+        if results_file is not None:
+            hs.close_results_file()
+
+    if only_count or results_file is not None:
         return hs.result_count()
     else:
         return [fmap_to_graphmap(G, H, f) for f in hs.result_list()]
 
-def find_retracts(G, results_limit=-1, only_count=False, max_depth=-1, partmap=None):
+
+def find_homomorphisms(G, H, results_limit=-1, only_count=False, max_depth=-1, partmap=None,
+                       results_file=None, cache=None, lists=None, value_order='index', value_seed=None):
     """
-    Run retract search on undirected graph `G`, return list of maps or their number (acc. to `only_count`),
+    Run G->H homomorphism search on graphs `G` and `H`, return list of maps or their number (acc. to `only_count`),
     starting with `partmap` G-H-map if given.
-    NOTE: always finds the identity.
+    The graphs may also be given as adjacency arrays (see `is_array_graph`) on vertices 0 .. n-1.
+    Directed graphs (and non-symmetric adjacency arrays) are supported, undirected graphs
+    are treated as symmetric digraphs.
+
+    With `lists`, finds list homomorphisms: every vertex maps only to its list of candidates,
+    given as a dict `{G-vertex: iterable of H-vertices}` or a |G| x |H| boolean matrix (see `lists_to_mask`).
+
+    With `results_file`, the maps (up to `results_limit`) are streamed into that binary file
+    instead of memory and their number is returned. Read the file with `load_results`.
+
+    With a `HomsearchCache` as `cache`, repeated queries are answered from the cache.
+
+    `value_order` sets the order in which the targets of a vertex are tried: 'index' (maps are found
+    in lexicographic order), 'lcv' (least constraining value first), 'degree' or 'n2' (largest H degree
+    or 2-neighborhood first), see `HomsearchInterface.set_value_order`. With an integer `value_seed`,
+    ties are broken randomly. Other orders than 'index' often find a map faster (e.g. with `results_limit=1`).
     """
 
-    assert not G.is_directed()
+    if (cache is not None) and (results_file is None):
+        return cache.query(G, H, False, results_limit, only_count, max_depth, partmap, lists=lists,
+                           value_order=value_order, value_seed=value_seed)
 
-    hs = HomsearchInterface(graph_to_adjlist(G), graph_to_adjlist(G),
-            results_limit, (not only_count), True, max_depth=max_depth)
+    hs = HomsearchInterface(graph_to_csr(G), graph_to_csr(H),
+            results_limit, (not only_count) and (results_file is None), False, max_depth=max_depth)
+    hs.set_value_order(value_order, value_seed)
+    if lists is not None:
+        hs.set_lists(lists_to_mask(G, H, lists))
 
-    if partmap is None:
+    return _run_search(hs, G, H, only_count, partmap, results_file)
+
+def find_retracts(G, results_limit=-1, only_count=False, max_depth=-1, partmap=None,
+                  results_file=None, cache=None, distinct_images=False, minimal_images=False, lists=None,
+                  value_order='index', value_seed=None):
+    """
+    Run retract search on graph `G`, return list of maps or their number (acc. to `only_count`),
+    starting with `partmap` G-H-map if given.
+    With `results_file`, the maps are streamed to the file, `cache`, `lists`, `value_order` and `value_seed`
+    are used as in `find_homomorphisms`.
+
+    With `distinct_images`, finds just one retraction for every distinct retract (image), branching on
+    which vertices are fix-points and looking for one retraction once the image is decided.
+    With `minimal_images`, finds only the inclusion-minimal retracts (retracts onto a core of `G` among them),
+    pruning branches containing an already found image.
+    `max_depth` should not be used with these.
+    NOTE: always finds the identity (or it is the only minimal image, if `G` is a core).
+    """
+
+    if (cache is not None) and (results_file is None):
+        return cache.query(G, G, True, results_limit, only_count, max_depth, partmap,
+                           distinct_images=distinct_images, minimal_images=minimal_images, lists=lists,
+                           value_order=value_order, value_seed=value_seed)
+
+    GG = graph_to_csr(G)
+    hs = HomsearchInterface(GG, GG,
+            results_limit, (not only_count) and (results_file is None), True, max_depth=max_depth)
+    hs.set_image_mode(distinct_images, minimal_images)
+    hs.set_value_order(value_order, value_seed)
+    if lists is not None:
+        hs.set_lists(lists_to_mask(G, G, lists))
+
+    return _run_search(hs, G, G, only_count, partmap, results_file)
+
+
+def count_extensions(G, H, partmaps, exists=False, threads=1, lists=None, value_order='index', value_seed=None):
+    """
+    Count the G->H homomorphisms extending every partial map in `partmaps`, in a single native call
+    running on `threads` threads. Returns a NumPy array of counts, or of booleans with `exists`
+    (stopping every search at the first map).
+    `partmaps` is either a k x |G| int matrix of numeric partial maps (-1 for unmapped, as `graphmap_to_fmap`)
+    or a list of G-H-maps (dicts). `lists`, `value_order` and `value_seed` are used as in `find_homomorphisms`.
+    """
+
+    if not isinstance(partmaps, numpy.ndarray):
+        partmaps = numpy.array([graphmap_to_fmap(G, H, pm) for pm in partmaps], dtype=numpy.intc)
+        partmaps = partmaps.reshape(-1, len(graph_vertices(G)))
+
+    hs = HomsearchInterface(graph_to_csr(G), graph_to_csr(H), -1, False, False)
+    hs.set_value_order(value_order, value_seed)
+    if lists is not None:
+        hs.set_lists(lists_to_mask(G, H, lists))
+    return hs.search_many(partmaps, exists=exists, threads=threads)
+
+
+
+
+#######################################
+# Approximate homomorphism counting
+
+HomCountEstimate = collections.namedtuple('HomCountEstimate', ['count', 'error', 'log_count', 'samples', 'converged'])
+HomCountEstimate.__doc__ = """
+Estimate of a homomorphism count: `count` with the confidence interval half-width `error`,
+`log_count` is the natural logarithm of `count` (finite even when `count` overflows a float).
+`converged` is False when `max_samples` ran out before reaching the requested precision.
+"""
+
+
+def _mean_of_logs(logs):
+    "Return (log of mean, relative standard error of the mean) of samples given by their logs"
+
+    finite = logs[numpy.isfinite(logs)]
+    if len(finite) == 0:
+        return (-math.inf, 0.0)
+    scaled = numpy.exp(logs - finite.max())
+    mean = scaled.mean()
+    rel_err = scaled.std(ddof=1) / math.sqrt(len(scaled)) / mean if len(scaled) > 1 else math.inf
+    return (float(finite.max() + math.log(mean)), float(rel_err))
+
+
+def count_homomorphisms(G, H, partmap=None, approx=False, epsilon=0.1, delta=0.05,
+                        max_samples=10 ** 6, batch_size=1000, threads=1, seed=None, lists=None):
+    """
+    Count the G->H homomorphisms extending `partmap` (and respecting `lists` as in `find_homomorphisms`),
+    exactly (same as `find_homomorphisms` with `only_count`)
+    or, with `approx`, estimate the count by random descents through the search tree.
+
+    Each descent picks the branching vertex as the search does and continues to a uniformly random
+    child consistent after candidate propagation, its estimate is the product of the numbers of such children
+    (Knuth's unbiased estimator). Batches of `batch_size` descents run on `threads` threads
+    until the confidence interval at level `1 - delta` (normal approximation) is within relative `epsilon`
+    or `max_samples` is reached. Returns a `HomCountEstimate`.
+    """
+
+    if not approx:
+        return find_homomorphisms(G, H, only_count=True, partmap=partmap, lists=lists)
+
+    hs = HomsearchInterface(graph_to_csr(G), graph_to_csr(H), -1, False, False)
+    if lists is not None:
+        hs.set_lists(lists_to_mask(G, H, lists))
+    f = None if partmap is None else graphmap_to_fmap(G, H, partmap)
+    rnd = random.Random(seed)
+    z = statistics.NormalDist().inv_cdf(1.0 - delta / 2.0)
+
+    logs = numpy.zeros(0)
+    log_count, rel_err = (-math.inf, math.inf)
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        while len(logs) < max_samples:
+            n = min(batch_size, (max_samples - len(logs) + threads - 1) // threads)
+            seeds = [rnd.getrandbits(64) for t in range(threads)]
+            batches = pool.map(lambda sd: hs.sample_log_counts(n, sd, f), seeds)
+            logs = numpy.concatenate([logs] + [numpy.array(b) for b in batches])
+            log_count, rel_err = _mean_of_logs(logs)
+            if z * rel_err <= epsilon:
+                break
+
+    converged = (z * rel_err <= epsilon)
+    if log_count == -math.inf:
+        # No successful descent (possibly there are no homomorphisms)
+        return HomCountEstimate(0.0, 0.0, log_count, len(logs), converged)
+    try:
+        count = math.exp(log_count)
+    except OverflowError:
+        count = float('inf')
+    return HomCountEstimate(count, z * rel_err * count, log_count, len(logs), converged)
+
+
+#######################################
+# Homomorphism profiles
+#
+# hom(F, H) is multiplicative over the components of F. Tree components are counted by dynamic
+# programming over H (vectors indexed by H vertices, memoized by AHU codes of the rooted subtrees,
+# so patterns share their common subtrees), cycles C_k by trace(A^k) (all lengths in one pass),
+# other components by the search engine.
+
+def _adjacency_product(Hc, dtype):
+    """
+    Return a function computing `A @ x` for the adjacency matrix `A` of CSR `Hc` and a vector (or matrix) `x`
+    of `dtype`, exact for int64 and object dtypes (uses SciPy for int64 if available).
+    """
+
+    indptr, indices = Hc
+    if (scipy is not None) and (dtype is numpy.int64):
+        A = scipy.sparse.csr_matrix((numpy.ones(len(indices), dtype=numpy.int64), indices, indptr),
+                                    shape=(len(indptr) - 1, len(indptr) - 1))
+        return lambda x: A @ x
+
+    def product(x):
+        s = numpy.cumsum(x[indices], axis=0)
+        s = numpy.concatenate((numpy.zeros((1, ) + x.shape[1:], dtype=x.dtype), s))
+        return s[indptr[1:]] - s[indptr[:-1]]
+    return product
+
+
+def _components(adj):
+    "Return the vertex lists of the connected components of the adjacency list `adj`"
+
+    seen, comps = set(), []
+    for v in range(len(adj)):
+        if v not in seen:
+            comp, stack = [], [v]
+            seen.add(v)
+            while stack:
+                u = stack.pop()
+                comp.append(u)
+                for w in adj[u]:
+                    if w not in seen:
+                        seen.add(w)
+                        stack.append(w)
+            comps.append(sorted(comp))
+    return comps
+
+
+def _tree_centers(adj, vs):
+    "Return the center (one or two vertices) of the tree on `vs`"
+
+    deg = dict((v, len(adj[v])) for v in vs)
+    leaves = [v for v in vs if deg[v] <= 1]
+    left = len(vs)
+    while left > 2:
+        left -= len(leaves)
+        nxt = []
+        for v in leaves:
+            for u in adj[v]:
+                deg[u] -= 1
+                if deg[u] == 1:
+                    nxt.append(u)
+        leaves = nxt
+    return leaves
+
+
+def _rooted_tree_code(adj, v, parent):
+    "AHU code of the subtree of `adj` at `v` (away from `parent`)"
+
+    return '(' + ''.join(sorted(_rooted_tree_code(adj, u, v) for u in adj[v] if u != parent)) + ')'
+
+
+def _tree_vector(code, n, product, memo, dtype):
+    """
+    Return the vector of the numbers of homomorphisms of the rooted tree given by AHU `code` to H
+    (on `n` vertices, adjacency `product` from `_adjacency_product`) mapping the root to each H vertex,
+    memoized in `memo`.
+    """
+
+    if code not in memo:
+        x = numpy.ones(n, dtype=dtype)
+        depth, start = 0, None
+        for i, c in enumerate(code[1:-1], 1):
+            if c == '(':
+                if depth == 0:
+                    start = i
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    child = code[start:i + 1]
+                    if ('A', child) not in memo:
+                        memo[('A', child)] = product(_tree_vector(child, n, product, memo, dtype))
+                    x = x * memo[('A', child)]
+        memo[code] = x
+    return memo[code]
+
+
+def _closed_walk_counts(Hc, lengths, dtype, block=256):
+    """
+    Return a dict of trace(A^k) for all k in `lengths`, A the (symmetric) adjacency matrix of CSR `Hc`.
+    Walks from blocks of start vertices are kept as sparse (sorted position, count) arrays up to length k/2,
+    trace(A^k) = sum(A^a * A^b) for a + b = k, so that the work is O(n * d^(k/2)) for maximum degree d.
+    """
+
+    indptr, indices = Hc
+    n = len(indptr) - 1
+    degs = numpy.diff(indptr)
+    res = dict((k, 0) for k in lengths)
+    half = (max(lengths) + 1) // 2
+    for start in range(0, n, block):
+        # Position u * block + c holds the number of walks from vertex `start + c` to vertex `u`
+        cols = numpy.arange(min(n, start + block) - start, dtype=numpy.int64)
+        X = [((cols + start) * block + cols, numpy.ones(len(cols), dtype=dtype))]
+        for j in range(half):
+            pos, cnt = X[-1]
+            rows = pos // block
+            d = degs[rows]
+            rep = numpy.repeat(numpy.arange(len(pos)), d)
+            offs = numpy.arange(len(rep)) - numpy.repeat(numpy.cumsum(d) - d, d)
+            new_pos = indices[indptr[rows][rep] + offs].astype(numpy.int64) * block + pos[rep] % block
+            order = numpy.argsort(new_pos, kind='stable')
+            new_pos, new_cnt = new_pos[order], cnt[rep][order]
+            if len(new_pos) == 0:
+                X.append((new_pos, new_cnt))
+                continue
+            firsts = numpy.flatnonzero(numpy.concatenate(([True], new_pos[1:] != new_pos[:-1])))
+            X.append((new_pos[firsts], numpy.add.reduceat(new_cnt, firsts)))
+        for k in lengths:
+            (pa, ca), (pb, cb) = X[k // 2], X[k - k // 2]
+            common, ia, ib = numpy.intersect1d(pa, pb, assume_unique=True, return_indices=True)
+            res[k] += int((ca[ia] * cb[ib]).sum())
+    return res
+
+
+def hom_profile(patterns, H, threads=1):
+    """
+    Return the numbers of homomorphisms hom(F, H) for every graph F in `patterns` as a NumPy array
+    (int64, or object dtype with Python ints if a count may not fit).
+
+    H is converted and preprocessed once. Tree components of the patterns are counted by dynamic programming
+    sharing the common rooted subtrees between all the patterns, cycle components by closed walk counts
+    of all the needed lengths at once, and the other components by the search engine on `threads` threads.
+    Directed patterns or `H` go to the search engine.
+    """
+
+    Hc = graph_to_csr(H)
+    n = len(Hc[0]) - 1
+    HT = edges_to_csr(n, Hc[1], numpy.repeat(numpy.arange(n), numpy.diff(Hc[0])))
+    H_symmetric = numpy.array_equal(Hc[0], HT[0]) and numpy.array_equal(Hc[1], HT[1])
+    max_deg = max(1, int(numpy.diff(Hc[0]).max())) if n > 0 else 1
+
+    # Split the patterns into components and classify them
+    pattern_parts = []
+    trees, cycles, others = {}, set(), {}
+    for F in patterns:
+        Fadj = graph_to_adjlist(F)
+        symmetric = all(u in Fadj[w] for u in range(len(Fadj)) for w in Fadj[u])
+        parts = []
+        for comp in (_components(Fadj) if (symmetric and H_symmetric) else [list(range(len(Fadj)))]):
+            num = dict(zip(comp, range(len(comp))))
+            cadj = [sorted(num[u] for u in Fadj[v] if u in num) for v in comp]
+            degs = [len(a) for a in cadj]
+            n_edges = sum(degs) // 2
+            loops = any(v in cadj[v] for v in range(len(comp)))
+            if not (symmetric and H_symmetric) or loops:
+                key = ('other', tuple(map(tuple, cadj)))
+            elif n_edges == len(comp) - 1:
+                key = ('tree', min(_rooted_tree_code(cadj, c, None) for c in _tree_centers(cadj, range(len(comp)))))
+            elif len(comp) >= 3 and all(d == 2 for d in degs):
+                key = ('cycle', len(comp))
+            else:
+                key = ('other', tuple(map(tuple, cadj)))
+            if key[0] == 'tree':
+                trees[key] = len(comp)
+            elif key[0] == 'cycle':
+                cycles.add(key)
+            else:
+                others[key] = cadj
+            parts.append(key)
+        pattern_parts.append(parts)
+
+    # Dynamic programming is exact in int64 when all counts are below n * max_deg^|component|
+    max_size = max(list(trees.values()) + [k for t, k in cycles] + [1])
+    dtype = numpy.int64 if n * max_deg ** max_size < 2 ** 63 else object
+
+    counts = {}
+    memo = {}
+    product = _adjacency_product(Hc, dtype)
+    for key in trees:
+        counts[key] = int(_tree_vector(key[1], n, product, memo, dtype).sum())
+    if cycles:
+        walks = _closed_walk_counts(Hc, set(k for t, k in cycles), dtype)
+        for key in cycles:
+            counts[key] = walks[key[1]]
+
+    def count_other(cadj):
+        hs = HomsearchInterface(cadj, Hc, -1, False, False)
         hs.search()
+        return hs.result_count()
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        for key, c in zip(others, pool.map(count_other, others.values())):
+            counts[key] = c
+
+    res = []
+    for parts in pattern_parts:
+        c = 1
+        for key in parts:
+            c *= counts[key]
+        res.append(c)
+    return numpy.array(res, dtype=(numpy.int64 if all(c < 2 ** 63 for c in res) else object))
+
+
+#######################################
+# Target ladders
+
+def find_threshold(G, targets, strategy='bisect', partmap=None):
+    """
+    Find the first target in `targets` that `G` maps to, for a monotone family of targets
+    (`G -> targets[i]` implies `G -> targets[j]` for all `j > i`, e.g. complete graphs K_1, K_2, ...
+    for the chromatic number, or a chain in the homomorphism order).
+    Returns `(index, map)`, or `(None, None)` if `G` maps to no target.
+    Targets not containing the images of `partmap` fail without search.
+
+    `G` is converted once, the search engine is built for every target tried. `strategy` is 'bisect'
+    (binary search), 'descend' (from the last target down) or 'ascend' (from the first target up);
+    monotonicity answers all the skipped targets. The last map found (for a larger target) is the branching
+    hint for the next searches, mapping vertices to the same labels where the next target has them
+    (as for nested targets). No other information (such as failed partial maps) is shared between targets.
+    """
+
+    assert strategy in ('bisect', 'descend', 'ascend')
+
+    Gc = graph_to_csr(G)
+    Gvs = graph_vertices(G)
+    found = {}    # index -> map or None
+    last = [None]
+
+    def test(i):
+        if i not in found:
+            T = targets[i]
+            Tnums = dict((v, vi) for vi, v in enumerate(graph_vertices(T)))
+            if partmap is not None and not all((u is None) or (u in Tnums) for u in partmap.values()):
+                # Partial map leaves the target
+                found[i] = None
+                return False
+            hs = HomsearchInterface(Gc, graph_to_csr(T), 1, True, False)
+            if last[0] is not None:
+                hs.set_hint([Tnums.get(last[0][v], -1) for v in Gvs])
+            if partmap is None:
+                hs.search()
+            else:
+                hs.search_from(graphmap_to_fmap(G, T, partmap))
+            res = hs.result_list()
+            found[i] = fmap_to_graphmap(G, T, res[0]) if res else None
+            if res:
+                last[0] = found[i]
+        return found[i] is not None
+
+    n = len(targets)
+    if strategy == 'bisect':
+        # Invariant: targets below lo fail, target hi (if < n) succeeds
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if test(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        first = hi
+    elif strategy == 'descend':
+        first = n
+        while first > 0 and test(first - 1):
+            first -= 1
     else:
-        hs.search_from(graphmap_to_fmap(G, G, partmap))
+        first = 0
+        while first < n and not test(first):
+            first += 1
 
-    if only_count:
-        return hs.result_count()
+    if first >= n:
+        return (None, None)
+    return (first, found[first])
+
+
+#######################################
+# Incremental sessions
+
+class HomsearchSession(object):
+    """
+    Incremental G->H homomorphism search over a sequence of small edits of (undirected) `G` and `H`.
+
+    The session keeps its own copies of the graphs (edit them with `add_edge`, `remove_edge`,
+    `add_vertex` and `remove_vertex`, passing 'G' or 'H' as `side`) and the last found map.
+    `find` returns the old map if the edits kept it valid; otherwise it first repairs the map
+    by searching again only the vertices around the violated edges (up to `repair_radius` steps away,
+    keeping the rest of the map fixed) and falls back to a full search.
+    `last_action` tells how the last `find` was answered: 'kept', 'known' (still no map),
+    'repaired' or 'searched'.
+    The search engine is built once per version of the graphs and reused by the repairs and the full search.
+    """
+
+    def __init__(self, G, H, repair_radius=2):
+        assert not G.is_directed()
+        assert not H.is_directed()
+        self.graphs = {'G': dict((v, set(G.neighbors(v))) for v in graph_vertices(G)),
+                       'H': dict((v, set(H.neighbors(v))) for v in graph_vertices(H))}
+        self.repair_radius = repair_radius
+        self.csr = {'G': None, 'H': None}
+        self.engine = None     # HomsearchInterface for the current graphs
+        self.f = None          # Last found map (valid up to `dirty`), None if none found
+        self.searched = False  # Has `find` run (so `f is None` means there is no map)?
+        self.relaxed = False   # Could the edits since the last `find` have created a map?
+        self.dirty = set()     # G vertices with possibly violated edges
+        self.last_action = None
+
+    def _edited(self, side):
+        self.csr[side] = None
+        self.engine = None
+
+    def add_vertex(self, side, v):
+        self.graphs[side].setdefault(v, set())
+        self._edited(side)
+        if side == 'G':
+            self.dirty.add(v)
+        else:
+            self.relaxed = True
+
+    def remove_vertex(self, side, v):
+        for u in list(self.graphs[side][v]):
+            self.remove_edge(side, v, u)
+        del self.graphs[side][v]
+        self._edited(side)
+        if side == 'G':
+            self.relaxed = True
+            self.dirty.discard(v)
+            if self.f is not None:
+                self.f.pop(v, None)
+        elif self.f is not None:
+            self.dirty.update(u for u in self.f if self.f[u] == v)
+
+    def add_edge(self, side, u, v):
+        for w in (u, v):
+            if w not in self.graphs[side]:
+                self.add_vertex(side, w)
+        self.graphs[side][u].add(v)
+        self.graphs[side][v].add(u)
+        self._edited(side)
+        if side == 'H':
+            self.relaxed = True
+        elif (self.f is not None) and (u in self.f) and (v in self.f):
+            if self.f[v] not in self.graphs['H'].get(self.f[u], ()):
+                self.dirty.update((u, v))
+
+    def remove_edge(self, side, u, v):
+        self.graphs[side][u].discard(v)
+        self.graphs[side][v].discard(u)
+        self._edited(side)
+        if side == 'G':
+            self.relaxed = True
+        elif self.f is not None:
+            # G edges mapped onto uv
+            for a, b in ((u, v), (v, u)):
+                for x in [x for x in self.f if self.f[x] == a]:
+                    for y in self.graphs['G'][x]:
+                        if self.f.get(y) == b:
+                            self.dirty.update((x, y))
+
+    def _graph_csr(self, side):
+        "Numbering (vertex list) and CSR adjacency of the current graph"
+        if self.csr[side] is None:
+            vs = list(self.graphs[side])
+            nums = dict(zip(vs, range(len(vs))))
+            adj = [[nums[u] for u in self.graphs[side][v]] for v in vs]
+            self.csr[side] = (vs, nums, adjacency_to_csr(adj))
+        return self.csr[side]
+
+    def _search(self, partmap):
+        "Find one map extending `partmap` (dict), or None"
+        Gvs, Gnums, Gc = self._graph_csr('G')
+        Hvs, Hnums, Hc = self._graph_csr('H')
+        if self.engine is None:
+            self.engine = HomsearchInterface(Gc, Hc, 1, True, False)
+        hs = self.engine
+        hs.reset_results()
+        hs.search_from([Hnums[partmap[v]] if v in partmap else -1 for v in Gvs])
+        res = hs.result_list()
+        if not res:
+            return None
+        return dict((Gvs[i], Hvs[res[0][i]]) for i in range(len(Gvs)))
+
+    def find(self):
+        "Return a G->H homomorphism for the current graphs (as a dict), or None if there is none"
+
+        if self.searched and (self.f is None) and not self.relaxed:
+            self.last_action = 'known'
+            return None
+
+        if (self.f is not None) and not self.dirty:
+            self.last_action = 'kept'
+            return dict(self.f)
+
+        f = None
+        if self.f is not None:
+            # Unmap the dirty vertices and their neighborhoods of growing radius
+            free = set(v for v in self.dirty if v in self.graphs['G'])
+            for r in range(self.repair_radius + 1):
+                if r > 0:
+                    free.update(u for v in list(free) for u in self.graphs['G'][v])
+                if len(free) >= len(self.graphs['G']):
+                    break
+                f = self._search(dict((v, fv) for v, fv in self.f.items() if v not in free))
+                if f is not None:
+                    self.last_action = 'repaired'
+                    break
+
+        if f is None:
+            f = self._search({})
+            self.last_action = 'searched'
+
+        self.f, self.searched, self.relaxed, self.dirty = f, True, False, set()
+        return None if f is None else dict(f)
+
+
+############################################
+# asyncio interface
+#
+# The searches run on `executor` (default loop executor) with the GIL released,
+# cancelling the awaiting task cancels the C++ search.
+
+async def aiter_homomorphisms(G, H, results_limit=-1, max_depth=-1, partmap=None,
+                              poll_interval=0.05, executor=None):
+    """
+    Asynchronous iterator over the G->H homomorphisms as found by `find_homomorphisms`,
+    yields lists (batches) of maps found since the previous batch, polling every `poll_interval` seconds.
+    """
+
+    hs = HomsearchInterface(graph_to_csr(G), graph_to_csr(H), results_limit, True, False, max_depth=max_depth)
+    loop = asyncio.get_running_loop()
+    if partmap is None:
+        fut = loop.run_in_executor(executor, hs.search)
     else:
-        return [fmap_to_graphmap(G, G, f) for f in hs.result_list()]
+        fut = loop.run_in_executor(executor, hs.search_from, graphmap_to_fmap(G, H, partmap))
+
+    try:
+        while True:
+            done, _pending = await asyncio.wait([fut], timeout=poll_interval)
+            batch = hs.take_results()
+            if batch:
+                yield [fmap_to_graphmap(G, H, f) for f in batch]
+            if done:
+                fut.result()
+                return
+    finally:
+        # Cancelled or closed early
+        hs.cancel()
+
 
+async def afind_homomorphisms(G, H, results_limit=-1, only_count=False, max_depth=-1, partmap=None,
+                              executor=None):
+    """
+    Asynchronous version of `find_homomorphisms` not blocking the event loop,
+    the search is stopped when the awaiting task is cancelled.
+    """
 
+    if not only_count:
+        res = []
+        async for batch in aiter_homomorphisms(G, H, results_limit, max_depth, partmap, executor=executor):
+            res.extend(batch)
+        return res
+
+    hs = HomsearchInterface(graph_to_csr(G), graph_to_csr(H), results_limit, False, False, max_depth=max_depth)
+    loop = asyncio.get_running_loop()
+    if partmap is None:
+        fut = loop.run_in_executor(executor, hs.search)
+    else:
+        fut = loop.run_in_executor(executor, hs.search_from, graphmap_to_fmap(G, H, partmap))
+
+    try:
+        await fut
+    except asyncio.CancelledError:
+        hs.cancel()
+        raise
+    return hs.result_count()
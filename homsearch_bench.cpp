@@ -0,0 +1,104 @@
+/*
+ * Copyright (c) 2015 Tomas Gavenciak <gavento@ucw.cz>
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy
+ * of this software and associated documentation files (the "Software"), to
+ * deal in the Software without restriction, including without limitation the
+ * rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+ * sell copies of the Software, and to permit persons to whom the Software is
+ * furnished to do so, subject to the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be included in
+ * all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ * IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ * FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ * AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ * LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ * DEALINGS IN THE SOFTWARE.
+ */
+
+/*
+ * C++-only benchmark driver, runs instances written by `homsearch_bench.py run --dump DIR`:
+ *
+ *     ./homsearch_bench [-r REPEAT] INSTANCE_FILE...
+ *
+ * Prints one JSON line per instance, as homsearch_bench.py does.
+ */
+
+#include "homsearch_lib.h"
+
+#include <chrono>
+#include <cstring>
+#include <fstream>
+#include <iostream>
+
+using namespace std;
+
+static bool read_graph(istream &in, vector<vector<int> > &G)
+{
+    int n, deg;
+    if (! (in >> n))
+        return false;
+    G.assign(n, vector<int>());
+    for (int v = 0; v < n; v++) {
+        if (! (in >> deg))
+            return false;
+        G[v].resize(deg);
+        for (int i = 0; i < deg; i++)
+            if (! (in >> G[v][i]))
+                return false;
+    }
+    return true;
+}
+
+int main(int argc, char **argv)
+{
+    int repeat = 3;
+    int first = 1;
+    if ((argc >= 3) && (strcmp(argv[1], "-r") == 0)) {
+        repeat = atoi(argv[2]);
+        first = 3;
+    }
+
+    for (int a = first; a < argc; a++) {
+        ifstream in(argv[a]);
+        string name, mode;
+        long long int res_limit, node_limit;
+        int res_store, retract_mode;
+        vector<vector<int> > G, H;
+
+        if (! ((in >> name >> mode >> res_limit >> res_store >> retract_mode >> node_limit) &&
+               read_graph(in, G) && read_graph(in, H))) {
+            cerr << "Invalid instance file " << argv[a] << "\n";
+            return 1;
+        }
+
+        double best = -1.0;
+        long long int count = 0, nodes = 0;
+        bool complete = true;
+        for (int r = 0; r < repeat; r++) {
+            auto t0 = chrono::steady_clock::now();
+            homsearch *h = new_homsearch(G, H, res_limit, res_store, retract_mode, -1);
+            h->node_limit = node_limit;
+            h->search(0);
+            double t = chrono::duration<double>(chrono::steady_clock::now() - t0).count();
+
+            if ((best < 0) || (t < best))
+                best = t;
+            count = h->res_count;
+            nodes = h->node_count;
+            complete = ! h->node_limit_reached();
+            delete h;
+        }
+
+        cout << "{\"name\": \"" << name << "\", \"mode\": \"" << mode << "\", \"n_G\": " << G.size()
+             << ", \"n_H\": " << H.size() << ", \"count\": " << count << ", \"nodes\": " << nodes
+             << ", \"complete\": " << (complete ? "true" : "false") << ", \"time\": " << best
+             << ", \"repeat\": " << repeat << ", \"driver\": \"c++\"}\n";
+    }
+
+    return 0;
+}
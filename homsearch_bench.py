@@ -0,0 +1,259 @@
+# Copyright (c) 2015 Tomas Gavenciak <gavento@ucw.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Reproducible homsearch benchmarks over the graph families we run.
+
+    python homsearch_bench.py run [--quick] [--output FILE] [--dump DIR]
+    python homsearch_bench.py compare OLD NEW
+
+`run` prints one JSON line per benchmark (instance, mode, size bucket, count, search nodes,
+completeness and the best time of `--repeat` runs). The graphs are deterministic (seeded),
+every run is capped by `--node-limit` search nodes, so node counts are comparable between commits.
+`--dump DIR` also writes the instances for the C++-only driver `homsearch_bench` (`make bench`).
+`compare` prints time ratios and node count changes between two outputs.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+
+from homsearch_interface import HomsearchInterface
+
+
+# Graph size buckets of new_homsearch (bitset sizes)
+SIZE_BUCKETS = [16, 32, 64, 128, 256, 1024, 4096]
+
+# Results stored by the "enumerate" mode
+ENUMERATE_LIMIT = 100000
+
+
+#############################
+# Graph family generators
+#
+# All return neighbor lists on vertices 0 .. n-1.
+
+def edges_to_adjlist(n, edges):
+    adj = [set() for v in range(n)]
+    for u, v in edges:
+        adj[u].add(v)
+        adj[v].add(u)
+    return [sorted(a) for a in adj]
+
+
+def complete_graph(k):
+    return edges_to_adjlist(k, itertools.combinations(range(k), 2))
+
+
+def cycle_graph(n):
+    return edges_to_adjlist(n, [(i, (i + 1) % n) for i in range(n)])
+
+
+def grid_graph(a, b):
+    edges = [(i * b + j, i * b + j + 1) for i in range(a) for j in range(b - 1)]
+    edges += [(i * b + j, (i + 1) * b + j) for i in range(a - 1) for j in range(b)]
+    return edges_to_adjlist(a * b, edges)
+
+
+def cube_like_graph(dim, extra_gens=()):
+    """
+    Cayley graph over Z_2^dim (vectors as bitmasks) generated by the unit vectors
+    and `extra_gens`, as `CayleyGraph` in attic/cayley.py.
+    """
+
+    gens = [1 << i for i in range(dim)] + list(extra_gens)
+    return edges_to_adjlist(2 ** dim, [(v, v ^ g) for v in range(2 ** dim) for g in gens])
+
+
+def kneser_graph(n, k):
+    "Kneser graph K(n, k): k-subsets of [n], adjacent when disjoint"
+
+    sets = [frozenset(s) for s in itertools.combinations(range(n), k)]
+    return edges_to_adjlist(len(sets), [(i, j) for i, j in itertools.combinations(range(len(sets)), 2)
+                                        if not (sets[i] & sets[j])])
+
+
+def gnp_graph(n, p, seed):
+    rnd = random.Random(seed)
+    return edges_to_adjlist(n, [e for e in itertools.combinations(range(n), 2) if rnd.random() < p])
+
+
+def size_bucket(n):
+    for b in SIZE_BUCKETS:
+        if n <= b:
+            return b
+    return None
+
+
+#############################
+# Benchmark suite
+
+def benchmarks(quick=False):
+    """
+    Generate the benchmark suite as dicts with keys `name`, `family`, `core` (True, False or None if unknown),
+    `G`, `H`, `mode` ("count", "enumerate", "exists" or "retract").
+    """
+
+    K3, K4 = complete_graph(3), complete_graph(4)
+
+    def bench(name, family, core, G, H, modes):
+        for mode in modes:
+            yield dict(name=name, family=family, core=core, G=G, H=(G if mode == 'retract' else H), mode=mode)
+
+    # Cube-like graphs: hypercubes (bipartite, not cores) and folded cubes (odd dimension: cores)
+    for dim in ([4, 5, 6] if quick else [4, 5, 6, 7, 8]):
+        Q = cube_like_graph(dim)
+        yield from bench('cube%d' % dim, 'cube-like', False, Q, K3, ['count', 'exists', 'retract'])
+        FQ = cube_like_graph(dim, [2 ** dim - 1])
+        yield from bench('folded_cube%d' % dim, 'cube-like', (dim % 2 == 1), FQ, K4,
+                         ['count', 'exists', 'retract'])
+
+    # Kneser graphs (cores), K(n, k) -> K_{n-2k+1} is the optimal coloring
+    for n, k in ([(5, 2), (7, 2), (8, 3)] if quick else [(5, 2), (7, 2), (8, 3), (9, 3), (10, 4), (11, 4)]):
+        G = kneser_graph(n, k)
+        yield from bench('kneser%d_%d' % (n, k), 'kneser', True, G, complete_graph(n - 2 * k + 1),
+                         ['count', 'exists'])
+        yield from bench('kneser%d_%d' % (n, k), 'kneser', True, G, complete_graph(n - 2 * k), ['exists'])
+        yield from bench('kneser%d_%d' % (n, k), 'kneser', True, G, G, ['retract'])
+
+    # Random graphs near the 3-colorability threshold (average degree ~4.69)
+    for n in ([12, 30, 60] if quick else [12, 30, 60, 120, 250, 1000]):
+        G = gnp_graph(n, 4.69 / n, seed=n)
+        yield from bench('gnp%d' % n, 'gnp', None, G, K3, ['count', 'enumerate', 'exists'])
+
+    # Grids (bipartite, not cores)
+    for a, b in ([(3, 4), (5, 6), (8, 8)] if quick else [(3, 4), (5, 6), (8, 8), (10, 12), (16, 16), (30, 30)]):
+        G = grid_graph(a, b)
+        yield from bench('grid%dx%d' % (a, b), 'grid', False, G, K3, ['count', 'enumerate', 'exists'])
+        yield from bench('grid%dx%d' % (a, b), 'grid', False, G, G, ['retract'])
+    if not quick:
+        # Largest size bucket, search states are too big for long runs
+        yield from bench('grid40x50', 'grid', False, grid_graph(40, 50), K3, ['exists'])
+
+    # Odd cycles (cores) versus even cycles
+    for n in ([9, 10] if quick else [9, 10, 31, 32, 101, 100]):
+        yield from bench('cycle%d' % n, 'cycle', (n % 2 == 1), cycle_graph(n), None, ['retract'])
+
+
+def mode_options(mode):
+    "HomsearchInterface (res_limit, res_store, retract_mode) for a benchmark mode"
+
+    return {'count': (-1, False, False),
+            'enumerate': (ENUMERATE_LIMIT, True, False),
+            'exists': (1, False, False),
+            'retract': (-1, False, True)}[mode]
+
+
+def run_benchmark(b, node_limit, repeat, value_order='index'):
+    "Run benchmark `b` (trying values in `value_order`, see `HomsearchInterface.set_value_order`), returns the result record"
+
+    res_limit, res_store, retract_mode = mode_options(b['mode'])
+    times = []
+    for r in range(repeat):
+        t0 = time.perf_counter()
+        hs = HomsearchInterface(b['G'], b['H'], res_limit, res_store, retract_mode)
+        hs.set_node_limit(node_limit)
+        hs.set_value_order(value_order)
+        hs.search()
+        times.append(time.perf_counter() - t0)
+
+    return {'name': b['name'], 'family': b['family'], 'core': b['core'], 'mode': b['mode'],
+            'n_G': len(b['G']), 'n_H': len(b['H']), 'bucket': size_bucket(max(len(b['G']), len(b['H']))),
+            'count': hs.result_count(), 'nodes': hs.node_count(), 'complete': not hs.node_limit_reached(),
+            'time': min(times), 'repeat': repeat, 'value_order': value_order}
+
+
+def dump_benchmark(b, node_limit, path):
+    """
+    Write benchmark `b` for the C++ driver: a line `name mode res_limit res_store retract_mode node_limit`,
+    then G and H, each as a line with the vertex count followed by one line `degree neighbors...` per vertex.
+    """
+
+    res_limit, res_store, retract_mode = mode_options(b['mode'])
+    with open(path, 'w') as f:
+        f.write('%s %s %d %d %d %d\n' % (b['name'], b['mode'], res_limit, res_store, retract_mode, node_limit))
+        for adj in (b['G'], b['H']):
+            f.write('%d\n' % len(adj))
+            for a in adj:
+                f.write(' '.join(str(x) for x in [len(a)] + list(a)) + '\n')
+
+
+def compare(old_path, new_path, out=sys.stdout):
+    "Print time ratios and node count changes between two `run` outputs"
+
+    def load(path):
+        with open(path) as f:
+            return dict(((r['name'], r['mode'], r['n_H']), r) for r in map(json.loads, f) if r)
+
+    old, new = load(old_path), load(new_path)
+    for key in sorted(set(old) & set(new)):
+        o, n = old[key], new[key]
+        flag = '' if (o['count'], o['complete']) == (n['count'], n['complete']) else '  RESULT CHANGED'
+        out.write('%-20s %-10s H=%-5d time %9.4fs -> %9.4fs (x%6.2f)  nodes %10d -> %10d%s\n' % (
+            key[0], key[1], key[2], o['time'], n['time'], n['time'] / max(o['time'], 1e-9),
+            o['nodes'], n['nodes'], flag))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Homsearch benchmarks")
+    sub = parser.add_subparsers(dest='command')
+    prun = sub.add_parser('run', help="Run the benchmarks")
+    prun.add_argument('--quick', action='store_true', help="Only small instances")
+    prun.add_argument('--repeat', type=int, default=3, help="Runs per benchmark (best time reported)")
+    prun.add_argument('--node-limit', type=int, default=10 ** 5, help="Search node budget per run")
+    prun.add_argument('--value-order', default='index', choices=['index', 'lcv', 'degree', 'n2'],
+                      help="Value ordering of the search (Python runs only)")
+    prun.add_argument('--filter', default='', help="Only benchmarks with names containing this")
+    prun.add_argument('--output', help="Write results to this file (default: stdout)")
+    prun.add_argument('--dump', metavar='DIR', help="Also write the instances for the C++ driver to DIR")
+    pcmp = sub.add_parser('compare', help="Compare two result files")
+    pcmp.add_argument('old')
+    pcmp.add_argument('new')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        compare(args.old, args.new)
+        return
+    if args.command != 'run':
+        parser.error("missing command")
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    if args.dump and not os.path.isdir(args.dump):
+        os.makedirs(args.dump)
+    try:
+        for i, b in enumerate(benchmarks(args.quick)):
+            if args.filter not in b['name']:
+                continue
+            if args.dump:
+                dump_benchmark(b, args.node_limit,
+                               os.path.join(args.dump, '%03d_%s_%s.txt' % (i, b['name'], b['mode'])))
+            out.write(json.dumps(run_benchmark(b, args.node_limit, args.repeat, args.value_order)) + '\n')
+            out.flush()
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
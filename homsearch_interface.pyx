@@ -27,7 +27,13 @@ Cython routines for finding graph homomorphisms.
 Do not use directly, only with the python module.
 """
 
+import os
+import itertools
+
+import numpy
+
 from libcpp.vector cimport vector
+from libcpp.string cimport string
 from libcpp cimport bool
 from cython.operator cimport dereference as deref
 
@@ -36,6 +42,7 @@ cdef extern from "homsearch_lib.h":
     cdef cppclass homsearch:
         # Graphs   
         vector[vector[int]] G, H
+        bool directed
 
         # Result options
         long long int res_count
@@ -43,26 +50,137 @@ cdef extern from "homsearch_lib.h":
         vector[vector[int]] res_list
         bool res_store
 
+        # Binary result file
+        bool open_res_file(string path, int width) except +
+        bool close_res_file()
+
+        # Search node budget
+        long long int node_count
+        long long int node_limit
+        bool node_limit_reached()
+
+        # Cancellation and incremental results
+        void cancel()
+        vector[vector[int]] take_results()
+
         # Other options
         bool retract_mode
         int max_depth
+        bool distinct_images
+        bool minimal_images
+        vector[int] hint
+        vector[unsigned char] cand_mask
+        int value_order_mode
+        bool value_random_ties
+        unsigned long long int value_seed
 
         # Search interface 
         void search_vector(vector[int] &f, int depth) nogil
         void search(int depth) nogil
+        vector[long long int] search_many(const vector[vector[int]] &fs, bool exists, int threads) nogil
+
+        # Search from another G to the same preprocessed H
+        homsearch *new_for_graph(const vector[vector[int]] &G, long long int res_limit, bool res_store,
+                                 int max_depth) except +
+
+        # Approximate counting
+        vector[double] sample_log_counts(long long int samples, unsigned long long int seed,
+                                         const vector[int] &f) nogil
 
     # helper to create right sized homsearch
     homsearch *new_homsearch(vector[vector[int]] &G, vector[vector[int]] &H,
-            long long int res_limit, bool res_store, bool retract_mode_, int max_depth)
+            long long int res_limit, bool res_store, bool retract_mode_, int max_depth) except +
+    homsearch *new_homsearch_csr(int nG, const int *G_indptr, const int *G_indices,
+            int nH, const int *H_indptr, const int *H_indices,
+            long long int res_limit, bool res_store, bool retract_mode_, int max_depth) except +
+
+
+def adjacency_to_csr(A):
+    """
+    Takes a graph adjacency and returns it as a CSR pair `(indptr, indices)` of contiguous int32 arrays.
+    Accepts a CSR pair `(indptr, indices)` (any tuple is taken as one, its items converted to arrays),
+    a SciPy sparse matrix, a dense NumPy adjacency matrix or a list of neighbor lists.
+    Raises ValueError for an invalid CSR pair (or neighbor lists).
+    """
+
+    if isinstance(A, tuple):
+        if len(A) != 2:
+            raise ValueError("A tuple adjacency must be a CSR pair (indptr, indices), got %d items" % (len(A), ))
+        indptr, indices = numpy.asarray(A[0]), numpy.asarray(A[1])
+    elif hasattr(A, 'tocsr'):
+        # SciPy sparse matrix
+        assert A.shape[0] == A.shape[1]
+        A = A.tocsr()
+        if A.nnz > 0 and not A.data.all():
+            A = A.copy()
+            A.eliminate_zeros()
+        indptr, indices = A.indptr, A.indices
+    elif isinstance(A, numpy.ndarray):
+        assert A.ndim == 2 and A.shape[0] == A.shape[1]
+        rows, indices = numpy.nonzero(A)
+        indptr = numpy.zeros(A.shape[0] + 1, dtype=numpy.intc)
+        numpy.cumsum(numpy.bincount(rows, minlength=A.shape[0]), out=indptr[1:])
+    else:
+        # List of neighbor lists
+        indptr = numpy.zeros(len(A) + 1, dtype=numpy.intc)
+        numpy.cumsum([len(a) for a in A], out=indptr[1:])
+        indices = numpy.fromiter(itertools.chain.from_iterable(A), dtype=numpy.intc, count=indptr[-1])
+
+    indptr = numpy.ascontiguousarray(indptr, dtype=numpy.intc)
+    indices = numpy.ascontiguousarray(indices, dtype=numpy.intc)
+    n = len(indptr) - 1
+    if not (n >= 0 and indptr[0] == 0 and indptr[n] == len(indices) and (numpy.diff(indptr) >= 0).all()):
+        raise ValueError("Invalid CSR adjacency: indptr must start at 0, be non-decreasing and end at len(indices)")
+    if not (len(indices) == 0 or (indices.min() >= 0 and indices.max() < n)):
+        raise ValueError("Invalid adjacency: neighbor indices must be in 0 .. %d" % (n - 1, ))
+    return (indptr, indices)
+
+
+# Value orders of homsearch_lib.h (value_order_t) by name
+VALUE_ORDERS = ['index', 'lcv', 'degree', 'n2']
+
+# Graph size buckets of homsearch_lib (new_homsearch picks the smallest fitting max(|G|, |H|))
+SIZE_LIMITS = [16, 32, 64, 128, 256, 1024, 4096]
+
+
+cdef const int *_data_ptr(const int[::1] a):
+    "Pointer to the array data, NULL for empty arrays"
+    if a.shape[0] == 0:
+        return NULL
+    return &a[0]
 
 
 cdef class HomsearchInterface:
-    "Mid-level interface to homsearch_lib working with graphs as neighbor lists on [0 .. n-1]"
+    """
+    Mid-level interface to homsearch_lib working with graphs on [0 .. n-1],
+    given as neighbor lists or anything accepted by `adjacency_to_csr`.
+    """
 
     cdef homsearch *srch
 
     def __init__(self, G_adj, H_adj, res_limit, res_store, retract_mode, max_depth=-1):
-        self.srch = new_homsearch(G_adj, H_adj, res_limit, res_store, retract_mode, max_depth)
+        cdef const int[::1] G_indptr, G_indices, H_indptr, H_indices
+        G_indptr, G_indices = adjacency_to_csr(G_adj)
+        H_indptr, H_indices = adjacency_to_csr(H_adj)
+
+        self.srch = new_homsearch_csr(G_indptr.shape[0] - 1, _data_ptr(G_indptr), _data_ptr(G_indices),
+                H_indptr.shape[0] - 1, _data_ptr(H_indptr), _data_ptr(H_indices),
+                res_limit, res_store, retract_mode, max_depth)
+
+    def for_graph(self, G_adj, res_limit, res_store, max_depth=-1):
+        """
+        Return a new (homomorphism) HomsearchInterface from `G_adj` to the same H, reusing the preprocessed H
+        (neighbor bitsets and value order scores) so that only G is built, or None if G does not fit
+        the size bucket of this search. Options are not copied.
+        """
+        indptr, indices = adjacency_to_csr(G_adj)
+        cdef vector[vector[int]] G = [indices[indptr[i]:indptr[i + 1]].tolist() for i in range(len(indptr) - 1)]
+        cdef homsearch *srch = self.srch.new_for_graph(G, res_limit, res_store, max_depth)
+        if srch == NULL:
+            return None
+        cdef HomsearchInterface hs = HomsearchInterface.__new__(HomsearchInterface)
+        hs.srch = srch
+        return hs
 
     def search(self):
         "Search from an empty mapping"
@@ -74,20 +192,158 @@ cdef class HomsearchInterface:
         "Search from a given partial mapping"
         assert isinstance(f, list)
         assert int(len(f)) == self.srch.G.size()
+        assert all(-1 <= fv < int(self.srch.H.size()) for fv in f)
         cdef vector[int] vf = f
 
         cdef homsearch *s = self.srch
         with nogil:
             s.search_vector(vf, 0)
 
+    def search_many(self, partmaps, exists=False, threads=1):
+        """
+        Count the maps extending every row of `partmaps`, a k x |G| int matrix of partial maps (-1 for unmapped),
+        in a single call on `threads` threads. Returns a NumPy array of k counts (up to res_limit each),
+        or of booleans with `exists`. Found maps are not stored.
+        """
+        cdef size_t nG = self.srch.G.size()
+        partmaps = numpy.ascontiguousarray(partmaps, dtype=numpy.intc)
+        assert partmaps.ndim == 2 and partmaps.shape[1] == nG
+        assert partmaps.size == 0 or (partmaps.min() >= -1 and partmaps.max() < int(self.srch.H.size()))
+
+        cdef const int[:, ::1] m = partmaps
+        cdef vector[vector[int]] fs
+        cdef Py_ssize_t i
+        fs.resize(m.shape[0])
+        for i in range(m.shape[0]):
+            if nG > 0:
+                fs[i].assign(&m[i, 0], &m[i, 0] + nG)
+
+        cdef vector[long long int] counts
+        cdef bool ex = exists
+        cdef int th = threads
+        cdef homsearch *s = self.srch
+        with nogil:
+            counts = s.search_many(fs, ex, th)
+
+        res = numpy.array(counts, dtype=numpy.int64).reshape(m.shape[0])
+        return (res > 0) if exists else res
+
+    def sample_log_counts(self, samples, seed, f=None):
+        """
+        Run `samples` random descents estimating the number of maps (extending partial map `f`),
+        returns the list of natural logarithms of the estimates (-inf for failed descents).
+        Does not modify the search state, may run from several threads at once.
+        """
+        if f is None:
+            f = [-1] * self.srch.G.size()
+        assert int(len(f)) == self.srch.G.size()
+        cdef vector[int] vf = f
+        cdef long long int n = samples
+        cdef unsigned long long int sd = seed
+        cdef vector[double] res
+
+        cdef homsearch *s = self.srch
+        with nogil:
+            res = s.sample_log_counts(n, sd, vf)
+        return res
+
     def result_list(self):
         "Return list of found maps (empty when res_store==False)"
         return self.srch.res_list
 
+    def open_results_file(self, path, width):
+        """
+        Append all found maps (up to res_limit) to file `path` as rows of `width`-byte ints (2 or 4).
+        Any header has to be written to the file before.
+        """
+        if not self.srch.open_res_file(os.fsencode(path), width):
+            raise IOError("Could not open result file %r" % (path, ))
+
+    def close_results_file(self):
+        "Flush and close the result file opened by `open_results_file`, raises IOError if any write failed"
+        if not self.srch.close_res_file():
+            raise IOError("Writing the result file failed, the results are incomplete")
+
     def result_count(self):
         "Return number of found maps (up to res_limit)"
         return self.srch.res_count
 
+    def reset_results(self):
+        "Forget the found maps, their count and the node count, to search again (not while searching)"
+        self.srch.res_list.clear()
+        self.srch.res_count = 0
+        self.srch.node_count = 0
+
+    def set_image_mode(self, distinct_images, minimal_images=False):
+        """
+        In retract mode, find only one retraction for every distinct image (fix-point set),
+        with `minimal_images` only for the inclusion-minimal images (reported after the search ends).
+        """
+        self.srch.distinct_images = distinct_images or minimal_images
+        self.srch.minimal_images = minimal_images
+
+    def set_hint(self, f):
+        "Set preferred targets (numeric map, -1 for none) tried first when branching, None to clear"
+        nH = self.srch.H.size()
+        if f is None:
+            f = []
+        else:
+            assert int(len(f)) == self.srch.G.size()
+            for fv in f:
+                assert -1 <= fv < nH
+        self.srch.hint = f
+
+    def set_value_order(self, order='index', seed=None):
+        """
+        Set the order of the candidate values tried when branching (after any hint): 'index' (by H vertex,
+        maps are found in lexicographic order), 'lcv' (least constraining value first: the most candidates
+        kept for the unmapped neighbors), 'degree' (largest H degree first) or 'n2' (largest H 2-neighborhood first).
+        With an integer `seed`, ties are broken randomly (reproducibly), otherwise by index.
+        """
+        self.srch.value_order_mode = VALUE_ORDERS.index(order)
+        self.srch.value_random_ties = seed is not None
+        self.srch.value_seed = 0 if seed is None else seed % (2 ** 64)
+
+    def set_lists(self, mask):
+        """
+        Restrict the candidate targets of every vertex of G to a list, given as a |G| x |H| boolean matrix
+        (`mask[v, u]` allows v -> u), None to remove the restriction. Applies to the following searches.
+        """
+        if mask is None:
+            self.srch.cand_mask.clear()
+            return
+        mask = numpy.ascontiguousarray(mask, dtype=numpy.uint8)
+        assert mask.shape == (self.srch.G.size(), self.srch.H.size())
+        cdef const unsigned char[::1] m = mask.reshape(-1)
+        if m.shape[0] == 0:
+            self.srch.cand_mask.clear()
+        else:
+            self.srch.cand_mask.assign(&m[0], &m[0] + m.shape[0])
+
+    def set_node_limit(self, node_limit):
+        "Stop the search after visiting `node_limit` search nodes (-1 for unlimited)"
+        self.srch.node_limit = node_limit
+
+    def node_count(self):
+        "Return the number of search nodes visited so far"
+        return self.srch.node_count
+
+    def cancel(self):
+        "Stop a search running in another thread as soon as possible"
+        self.srch.cancel()
+
+    def take_results(self):
+        "Remove and return the maps found so far, may be called while the search runs in another thread"
+        return self.srch.take_results()
+
+    def node_limit_reached(self):
+        "Was the search cut short by the node limit? (Results are then incomplete)"
+        return self.srch.node_limit_reached()
+
+    def is_directed(self):
+        "Is G or H directed (not symmetric)?"
+        return self.srch.directed
+
     def __del__(self):
         del self.srch
 
@@ -22,6 +22,91 @@
 
 #include "homsearch_lib.h"
 
+///////////////////////////////////////////////////////////
+// Binary result file
+
+bool homsearch::open_res_file(const string &path, int width)
+{
+    if ((width != 2) && (width != 4))
+        throw invalid_argument("result file width must be 2 or 4 bytes");
+    close_res_file();
+
+    res_file = fopen(path.c_str(), "ab");
+    if (! res_file)
+        return false;
+    // Rows are small, buffer generously
+    setvbuf(res_file, NULL, _IOFBF, 1 << 20);
+    res_file_width = width;
+    res_file_error = false;
+    return true;
+}
+
+bool homsearch::close_res_file()
+{
+    bool ok = ! res_file_error;
+    if (res_file && (fclose(res_file) != 0))
+        ok = false;
+    res_file = NULL;
+    res_file_error = false;
+    return ok;
+}
+
+void homsearch::write_res_file(const vector<int> &f)
+{
+    if (res_file_width == 4) {
+        vector<int32_t> row(f.begin(), f.end());
+        if (fwrite(row.data(), sizeof(int32_t), row.size(), res_file) != row.size())
+            res_file_error = true;
+    } else {
+        vector<int16_t> row(f.begin(), f.end());
+        if (fwrite(row.data(), sizeof(int16_t), row.size(), res_file) != row.size())
+            res_file_error = true;
+    }
+}
+
+///////////////////////////////////////////////////////////
+// Batched searches
+
+vector<long long int> homsearch::search_many(const vector<vector<int> > &fs, bool exists, int threads)
+{
+    vector<long long int> counts(fs.size(), 0);
+    threads = max(1, min(threads, (int)fs.size()));
+
+    // One search copy per thread, the partial maps are taken in order
+    vector<homsearch *> copies;
+    for (int t = 0; t < threads; t++) {
+        homsearch *h = clone();
+        h->res_store = false;
+        if (exists)
+            h->res_limit = 1;
+        copies.push_back(h);
+    }
+    atomic<size_t> next(0);
+
+    auto worker = [&](homsearch *h) {
+        size_t i;
+        while (((i = next++) < fs.size()) && ! cancelled.load(memory_order_relaxed)) {
+            h->res_count = 0;
+            h->node_count = 0;
+            h->search_vector(fs[i], 0);
+            counts[i] = h->res_count;
+            lock_guard<mutex> lock(res_mutex);
+            node_count += h->node_count;
+        }
+    };
+
+    vector<thread> running;
+    for (int t = 1; t < threads; t++)
+        running.push_back(thread(worker, copies[t]));
+    worker(copies[0]);
+    for (auto &th: running)
+        th.join();
+
+    for (auto h: copies)
+        delete h;
+    return counts;
+}
+
 ///////////////////////////////////////////////////////////
 // Helper to create the right instance of homsearch_impl<>
 
@@ -55,3 +140,22 @@ homsearch *new_homsearch(const vector<vector<int> > &G, const vector<vector<int>
 }
 
 
+
+///////////////////////////////////////////////////////////
+// Helper to create homsearch_impl<> from CSR adjacency arrays
+
+static vector<vector<int> > csr_to_adjlist(int n, const int *indptr, const int *indices)
+{
+    vector<vector<int> > adj(n);
+    for (int v = 0; v < n; v++)
+        adj[v].assign(indices + indptr[v], indices + indptr[v + 1]);
+    return adj;
+}
+
+homsearch *new_homsearch_csr(int nG, const int *G_indptr, const int *G_indices,
+              int nH, const int *H_indptr, const int *H_indices,
+              long long int res_limit, bool res_store, bool retract_mode, int max_depth)
+{
+    return new_homsearch(csr_to_adjlist(nG, G_indptr, G_indices), csr_to_adjlist(nH, H_indptr, H_indices),
+                         res_limit, res_store, retract_mode, max_depth);
+}
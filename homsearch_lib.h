@@ -28,7 +28,16 @@
 // #define LIMIT_D3
 
 #include <bitset>
+#include <string>
 #include <vector>
+#include <cstdio>
+#include <mutex>
+#include <thread>
+#include <atomic>
+#include <random>
+#include <cmath>
+#include <limits>
+#include <memory>
 #include <cassert>
 #include <cstdint>
 #include <iostream>
@@ -41,46 +50,158 @@ using namespace std;
 /////////////////////////////////////
 // Generic interface - virtual class
 
+// Order of the candidate values tried when branching (after the hint)
+enum value_order_t {
+    VALUE_ORDER_INDEX = 0,    // By H vertex index (results in lexicographic order)
+    VALUE_ORDER_LCV = 1,      // Least constraining value first: most candidates kept for the unmapped neighbors
+    VALUE_ORDER_DEGREE = 2,   // Largest H degree first
+    VALUE_ORDER_N2 = 3        // Largest H 2-neighborhood first
+};
+
 class homsearch {
    public:
-    // Graphs
+    // Graphs, G[v] are the out-neighbors of v
     const vector<vector<int> > G;
     const vector<vector<int> > H;
 
+    // Is G or H directed (adjacency not symmetric)? Undirected graphs are symmetric digraphs.
+    bool directed;
+
     // Results
     long long int res_limit;
     long long int res_count;
     vector<vector<int> > res_list;
     bool res_store;
 
+    // Optional binary result file, see open_res_file()
+    FILE *res_file;
+    int res_file_width;
+    bool res_file_error;
+
+    // Search node budget, -1 for unlimited
+    long long int node_count;
+    long long int node_limit;
+
+    // Set (from any thread) to stop the search
+    atomic<bool> cancelled;
+
+    // Guards res_list for take_results() during the search
+    mutex res_mutex;
+
     // Options
     int max_depth;
     bool retract_mode;
 
+    // Retract mode: report one retraction per distinct image (fix-point set),
+    // optionally only the inclusion-minimal images
+    bool distinct_images;
+    bool minimal_images;
+
+    // Optional preferred target for every G vertex (-1 for none), tried first when branching
+    vector<int> hint;
+
+    // Optional initial candidate lists as a |G| x |H| row-major 0/1 matrix (empty for all candidates)
+    vector<unsigned char> cand_mask;
+
+    // Value ordering (a value_order_t), ties broken by index or randomly (seeded by value_seed)
+    int value_order_mode;
+    bool value_random_ties;
+    unsigned long long int value_seed;
+
    public:
     homsearch(const vector<vector<int> > &G_, const vector<vector<int> > &H_,
               long long int res_limit_, bool res_store_, bool retract_mode_, int max_depth_):
-      G(G_), H(H_), 
+      G(G_), H(H_), directed(false),
       res_limit(res_limit_), res_count(0), res_list(), res_store(res_store_),
-      max_depth(max_depth_), retract_mode(retract_mode_) {}
+      res_file(NULL), res_file_width(0), res_file_error(false),
+      node_count(0), node_limit(-1), cancelled(false),
+      max_depth(max_depth_), retract_mode(retract_mode_),
+      distinct_images(false), minimal_images(false), hint(), cand_mask(),
+      value_order_mode(VALUE_ORDER_INDEX), value_random_ties(false), value_seed(0) {}
 
     homsearch(const homsearch &from):
-      G(from.G), H(from.H),
+      G(from.G), H(from.H), directed(from.directed),
       res_limit(from.res_limit), res_count(0), res_list(), res_store(from.res_store),
-      max_depth(from.max_depth), retract_mode(from.retract_mode) {}
+      res_file(NULL), res_file_width(0), res_file_error(false),
+      node_count(0), node_limit(from.node_limit), cancelled(false),
+      max_depth(from.max_depth), retract_mode(from.retract_mode),
+      distinct_images(from.distinct_images), minimal_images(from.minimal_images), hint(from.hint),
+      cand_mask(from.cand_mask),
+      value_order_mode(from.value_order_mode), value_random_ties(from.value_random_ties),
+      value_seed(from.value_seed) {}
 
-    virtual ~homsearch() = default;
+    virtual ~homsearch() { close_res_file(); }
+
+   public:
+
+    // Append every found map to file `path` as a row of `width`-byte (2 or 4) ints,
+    // in addition to (or instead of) `res_list`. Any file header must be already written.
+    // Returns false if the file could not be opened.
+    bool open_res_file(const string &path, int width);
+
+    // Flush and close the result file (if open)
+    // Returns false if any write (or the flush) failed, the file is then incomplete.
+    bool close_res_file();
+
+   protected:
+    void write_res_file(const vector<int> &f);
 
    public:
 
     virtual void search_vector(const vector<int> &f, int depth = 0) = 0;
 
+    // A copy of the search with the same graphs and options, but no results
+    virtual homsearch *clone() const = 0;
+
+    // A new homomorphism search from G_ to the same H (with default options), reusing the H neighbor
+    // bitsets and value order scores, so that only G_ is preprocessed.
+    // Returns NULL if G_ does not fit the size bucket of this search.
+    virtual homsearch *new_for_graph(const vector<vector<int> > &G_, long long int res_limit_, bool res_store_,
+                                     int max_depth_ = -1) const = 0;
+
+    // Count the maps extending every partial map in `fs` (up to res_limit each, only 0/1 with `exists`)
+    // using `threads` copies of the search. The maps are not stored, node_limit applies to every search.
+    // Adds the search nodes of all the searches to node_count.
+    vector<long long int> search_many(const vector<vector<int> > &fs, bool exists, int threads);
+
+    // Estimate the number of extensions of `f` by `samples` random descents (Knuth's estimator),
+    // returns the natural logarithm of every estimate (-inf for failed descents). Thread-safe.
+    virtual vector<double> sample_log_counts(long long int samples, unsigned long long int seed,
+                                             const vector<int> &f) const = 0;
+
     virtual void search(int depth = 0)
     {
         vector<int> f0(G.size(), -1);
         search_vector(f0, depth);
     }
 
+    // Was the search cut short by node_limit?
+    bool node_limit_reached() const
+    {
+        return (node_limit >= 0) && (node_count > node_limit);
+    }
+
+    // Should the search stop (node_limit or cancelled)?
+    bool search_stopped() const
+    {
+        return node_limit_reached() || cancelled.load(memory_order_relaxed);
+    }
+
+    // Stop the running search as soon as possible, safe to call from other threads
+    void cancel()
+    {
+        cancelled = true;
+    }
+
+    // Remove and return the maps stored in res_list so far, safe to call during the search
+    vector<vector<int> > take_results()
+    {
+        vector<vector<int> > taken;
+        lock_guard<mutex> lock(res_mutex);
+        taken.swap(res_list);
+        return taken;
+    }
+
 };
 
 
@@ -114,10 +235,13 @@ class homsearch_state {
     {
         assert((f_ == NULL) || (f_->size() == search->G.size()));
 
-        // Initialize full candidate lists
+        // Initialize full candidate lists (or the given ones)
+        const vector<unsigned char> &mask = search_->cand_mask;
+        unsigned int nH = search_->H.size();
+        assert(mask.empty() || (mask.size() == search_->G.size() * nH));
         for (unsigned int v = 0; v < search_->G.size(); v++) {
-            for (unsigned int i = 0; i < search_->H.size(); i++)
-                  candidates[v][i] = 1;
+            for (unsigned int i = 0; i < nH; i++)
+                  candidates[v][i] = mask.empty() || mask[v * nH + i];
         }
 
         // Set partial map and limit candidates
@@ -125,7 +249,11 @@ class homsearch_state {
             for (unsigned int i = 0; i < search->G.size(); i++) {
                 if ((*f_)[i] != -1) {
 //                    cout << i << " -> " << (*f_)[i] << "\n";
-                    if (! set_map(i, (*f_)[i])) {
+                    if ((f[i] != -1) || (! candidates[i][(*f_)[i]])) {
+                        // Already excluded (or mapped to a fix-point in retract mode)
+                        if (f[i] != (*f_)[i])
+                            state_valid = false;
+                    } else if (! set_map(i, (*f_)[i])) {
                         // Such partial mapping is not extendible!
                         state_valid = false;
                     }
@@ -146,13 +274,22 @@ class homsearch_state {
 
         // Find dist=1 vertices
         bitset<size_lim> N1G = search->G_neighbors[v];
-        bitset<size_lim> N1H = search->H_neighbors[fv];
+        bitset<size_lim> N1H = (*search->H_neighbors)[fv];
 
         // Limit dist=1 neighborhood candidates
         for (unsigned int n = 0; n < N1G.size(); n++)
-            if ((f[n] == -1) && (N1G[n]))
+            if ((N1G[n]) && (f[n] == -1))
                 candidates[n] &= N1H;
 
+        // A loop at v needs a loop at fv
+        if (N1G[v] && ! N1H[fv])
+            return false;
+
+        if (search->directed) {
+            // Same for in-neighbors and along the directed walks of length 2
+            limit_directed(v, fv);
+        } else {
+
 #ifdef LIMIT_D2
 
         // Find dist=2 vertices
@@ -163,11 +300,11 @@ class homsearch_state {
         bitset<size_lim> N2H;
         for (unsigned int n = 0; n < N1H.size(); n++)
             if (N1H[n])
-                N2H |= search->H_neighbors[n];
+                N2H |= (*search->H_neighbors)[n];
                 
         // Limit dist=2 neighborhood candidates
         for (unsigned int n = 0; n < N2G.size(); n++)
-            if ((f[n] == -1) && (N2G[n]))
+            if ((N2G[n]) && (f[n] == -1))
                 candidates[n] &= N2H;
 
 #ifdef LIMIT_D3
@@ -180,16 +317,18 @@ class homsearch_state {
         bitset<size_lim> N3H;
         for (unsigned int n = 0; n < N2H.size(); n++)
             if (N2H[n])
-                N3H |= search->H_neighbors[n];
+                N3H |= (*search->H_neighbors)[n];
 
         // Limit dist=3 neighborhood candidates
         for (unsigned int n = 0; n < N3G.size(); n++)
-            if ((f[n] == -1) && (N3G[n]))
+            if ((N3G[n]) && (f[n] == -1))
                 candidates[n] &= N3H;
 
 #endif // LIMIT_D3
 #endif // LIMIT_D2
 
+        }
+
 //        cout << "set_map(" << v << ", " << fv << ")\n    N1G=" << N1G << " N1H=" << N1H << "\n    N2G=" << N2G << " N2H=" << N2H << "\n";
 
         if (search->retract_mode) {
@@ -221,6 +360,48 @@ class homsearch_state {
 
         return true;
     }
+
+    // Retract mode: v is not a fix-point (not in the image), so no unmapped vertex maps to v
+    void exclude_target(int v)
+    {
+        for (unsigned int i = 0; i < candidates.size(); i ++)
+            if (f[i] == -1)
+                candidates[i][v] = 0;
+    }
+
+    // Limit candidates of the in-neighbors of v (just mapped to fv) and, with LIMIT_D2,
+    // of the vertices at the ends of the four kinds of directed walks of length 2 from v
+    // (out-out, out-in, in-out, in-in)
+    void limit_directed(int v, int fv)
+    {
+        const bitset<size_lim> *GN[2] = {&search->G_neighbors[v], &search->G_in_neighbors[v]};
+        const bitset<size_lim> *HN[2] = {&(*search->H_neighbors)[fv], &(*search->H_in_neighbors)[fv]};
+
+        for (unsigned int n = 0; n < GN[1]->size(); n++)
+            if ((*GN[1])[n] && (f[n] == -1))
+                candidates[n] &= *HN[1];
+
+#ifdef LIMIT_D2
+
+        const vector<bitset<size_lim> > *GA[2] = {&search->G_neighbors, &search->G_in_neighbors};
+        const vector<bitset<size_lim> > *HA[2] = {search->H_neighbors.get(), search->H_in_neighbors.get()};
+        for (int d1 = 0; d1 < 2; d1++) {
+            for (int d2 = 0; d2 < 2; d2++) {
+                bitset<size_lim> N2G, N2H;
+                for (unsigned int n = 0; n < GN[d1]->size(); n++)
+                    if ((*GN[d1])[n])
+                        N2G |= (*GA[d2])[n];
+                for (unsigned int n = 0; n < HN[d1]->size(); n++)
+                    if ((*HN[d1])[n])
+                        N2H |= (*HA[d2])[n];
+                for (unsigned int n = 0; n < N2G.size(); n++)
+                    if ((N2G[n]) && (f[n] == -1))
+                        candidates[n] &= N2H;
+            }
+        }
+
+#endif // LIMIT_D2
+    }
 };
 
 
@@ -232,48 +413,258 @@ class homsearch_impl: public homsearch {
 
    public:
     vector <bitset<size_lim> > G_neighbors;
-    vector<bitset<size_lim> > H_neighbors;
+
+    // In-neighbors, only for directed graphs
+    vector<bitset<size_lim> > G_in_neighbors;
+
+    // Neighbor maps in H, read-only and shared with clones and the searches made by new_for_graph.
+    // The in-neighbor map is the same object for a symmetric H.
+    shared_ptr<const vector<bitset<size_lim> > > H_neighbors;
+    shared_ptr<const vector<bitset<size_lim> > > H_in_neighbors;
+
+    // Total (in and out) degrees of G vertices
+    vector<int> G_degree;
+
+    // Value ordering scores of H vertices for VALUE_ORDER_DEGREE and VALUE_ORDER_N2,
+    // computed on first use (see prepare_value_order) and kept for all searches
+    vector<int> H_degree;
+    vector<int> H_n2_size;
+
+    // Random tie-breaking
+    mt19937_64 value_rng;
+
+    // Images found in distinct_images mode and their retractions
+    vector<bitset<size_lim> > found_images;
+    vector<vector<int> > found_image_maps;
 
    public:
     homsearch_impl(const vector<vector<int> > &G_, const vector<vector<int> > &H_,
               long long int res_limit_, bool res_store_, bool retract_mode_, int max_depth_ = -1):
       homsearch(G_, H_, res_limit_, res_store_, retract_mode_, max_depth_),
-      G_neighbors(G.size()), H_neighbors(H.size())
+      G_neighbors(G.size()), G_in_neighbors(G.size()), G_degree(G.size())
     {   
-        // Neighbor map in G
-        for (unsigned int v = 0; v < G.size(); v++)
-            for (auto i: G[v])
-                G_neighbors[v][i] = 1;
-
         // Neighbor map in H
+        auto HN = make_shared<vector<bitset<size_lim> > >(H.size());
+        auto HIN = make_shared<vector<bitset<size_lim> > >(H.size());
         for (unsigned int v = 0; v < H.size(); v++)
-            for (auto i: H[v])
-                H_neighbors[v][i] = 1;
+            for (auto i: H[v]) {
+                (*HN)[v][i] = 1;
+                (*HIN)[i][v] = 1;
+            }
+        H_neighbors = HN;
+        H_in_neighbors = (*HN == *HIN) ? H_neighbors : HIN;
+
+        finish_init();
+    }
+
+    // Search from G_ to the H of `target`, sharing its H neighbor maps (see new_for_graph)
+    homsearch_impl(const homsearch_impl<size_lim> &target, const vector<vector<int> > &G_,
+              long long int res_limit_, bool res_store_, int max_depth_):
+      homsearch(G_, target.H, res_limit_, res_store_, false, max_depth_),
+      G_neighbors(G.size()), G_in_neighbors(G.size()),
+      H_neighbors(target.H_neighbors), H_in_neighbors(target.H_in_neighbors), G_degree(G.size())
+    {
+        finish_init();
+
+        // H degrees count the in-neighbors only in directed searches
+        if (directed == target.directed) {
+            H_degree = target.H_degree;
+            H_n2_size = target.H_n2_size;
+        }
     }
 
     homsearch_impl(const homsearch_impl<size_lim> &from):
       homsearch(from),
-      G_neighbors(from.G_neighbors), H_neighbors(from.H_neighbors) {}
+      G_neighbors(from.G_neighbors), G_in_neighbors(from.G_in_neighbors),
+      H_neighbors(from.H_neighbors), H_in_neighbors(from.H_in_neighbors), G_degree(from.G_degree),
+      H_degree(from.H_degree), H_n2_size(from.H_n2_size) {}
 
     virtual ~homsearch_impl() = default;
 
 
+  private:
+    // Build the G side (neighbor maps and degrees), detect directed searches,
+    // drop the G in-neighbors of undirected searches
+    void finish_init()
+    {
+        // Neighbor map in G
+        for (unsigned int v = 0; v < G.size(); v++)
+            for (auto i: G[v]) {
+                G_neighbors[v][i] = 1;
+                G_in_neighbors[i][v] = 1;
+            }
+
+        // (the H maps are the same object for a symmetric H)
+        directed = (G_neighbors != G_in_neighbors) || (H_neighbors != H_in_neighbors);
+        for (unsigned int v = 0; v < G.size(); v++)
+            G_degree[v] = G[v].size() + (directed ? G_in_neighbors[v].count() : 0);
+        if (! directed)
+            G_in_neighbors.clear();
+    }
+
    public:
+    virtual homsearch *clone() const
+    {
+        return new homsearch_impl<size_lim>(*this);
+    }
+
+    virtual homsearch *new_for_graph(const vector<vector<int> > &G_, long long int res_limit_, bool res_store_,
+                                     int max_depth_ = -1) const
+    {
+        if (G_.size() > size_lim)
+            return NULL;
+        return new homsearch_impl<size_lim>(*this, G_, res_limit_, res_store_, max_depth_);
+    }
+
     virtual void search_state(const homsearch_state<size_lim> &s, int depth = 0);
 
     virtual void search_vector(const vector<int> &f, int depth = 0)
     {
+        prepare_value_order();
         homsearch_state<size_lim> s0(this, &f);
-        search_state(s0, depth);
+        found_images.clear();
+        found_image_maps.clear();
+        if (retract_mode && distinct_images)
+            search_images(s0);
+        else
+            search_state(s0, depth);
+
+        // Minimal images are only known after the search
+        if (retract_mode && distinct_images && minimal_images) {
+            for (unsigned int i = 0; i < found_images.size(); i++) {
+                if ((res_limit >= 0) && (res_count >= res_limit))
+                    break;
+                bool minimal = true;
+                for (unsigned int j = 0; j < found_images.size(); j++)
+                    if ((j != i) && (found_images[j] & ~found_images[i]).none())
+                        minimal = false;
+                if (minimal)
+                    add_res(found_image_maps[i]);
+            }
+        }
+    }
+
+    // Compute the H scores needed by value_order_mode (if not yet known), reseed the tie-breaking
+    void prepare_value_order()
+    {
+        value_rng.seed(value_seed);
+
+        if ((value_order_mode == VALUE_ORDER_DEGREE) && H_degree.empty()) {
+            H_degree.resize(H.size());
+            for (unsigned int u = 0; u < H.size(); u++)
+                H_degree[u] = H[u].size() + (directed ? (*H_in_neighbors)[u].count() : 0);
+        }
+
+        if ((value_order_mode == VALUE_ORDER_N2) && H_n2_size.empty()) {
+            H_n2_size.resize(H.size());
+            for (unsigned int u = 0; u < H.size(); u++) {
+                bitset<size_lim> N2;
+                for (auto w: H[u])
+                    N2 |= (*H_neighbors)[w];
+                H_n2_size[u] = N2.count();
+            }
+        }
+    }
+
+    // Candidate values are tried by index, without building an order (no hint, default order)
+    bool index_value_order() const
+    {
+        return (hint.size() != G.size()) && (value_order_mode == VALUE_ORDER_INDEX) && (! value_random_ties);
+    }
+
+    // Order of candidate values tried for v: the hint first (if any), then by value_order_mode
+    vector<int> value_order(const homsearch_state<size_lim> &s, int v)
+    {
+        vector<int> order;
+        int first = (hint.size() == G.size()) ? hint[v] : -1;
+        for (int fv = 0; fv < (int)H.size(); fv ++)
+            if (s.candidates[v][fv] && (fv != first))
+                order.push_back(fv);
+
+        if ((value_order_mode != VALUE_ORDER_INDEX) || value_random_ties) {
+            // Sort by (score descending, tie-breaker)
+            vector<pair<long long int, unsigned long long int> > key(H.size());
+            for (int fv: order) {
+                long long int score = 0;
+                if (value_order_mode == VALUE_ORDER_LCV)
+                    score = candidates_kept(s, v, fv);
+                else if (value_order_mode == VALUE_ORDER_DEGREE)
+                    score = H_degree[fv];
+                else if (value_order_mode == VALUE_ORDER_N2)
+                    score = H_n2_size[fv];
+                key[fv] = make_pair(-score, value_random_ties ? value_rng() : (unsigned long long int)fv);
+            }
+            sort(order.begin(), order.end(), [&key](int a, int b) { return key[a] < key[b]; });
+        }
+
+        if ((first >= 0) && s.candidates[v][first])
+            order.insert(order.begin(), first);
+        return order;
+    }
+
+    // Total number of candidates left to the unmapped neighbors of v when mapping v to fv
+    long long int candidates_kept(const homsearch_state<size_lim> &s, int v, int fv) const
+    {
+        long long int kept = 0;
+        for (auto n: G[v])
+            if (s.f[n] == -1)
+                kept += (s.candidates[n] & (*H_neighbors)[fv]).count();
+        if (directed)
+            for (unsigned int n = 0; n < G.size(); n++)
+                if (G_in_neighbors[v][n] && (s.f[n] == -1))
+                    kept += (s.candidates[n] & (*H_in_neighbors)[fv]).count();
+        return kept;
+    }
+
+    // Find any extension of the state, returns success
+    bool search_first(const homsearch_state<size_lim> &s, vector<int> &res);
+
+    virtual vector<double> sample_log_counts(long long int samples, unsigned long long int seed,
+                                             const vector<int> &f) const;
+
+    // Select the branching vertex minimizing #candidates and maximizing degree,
+    // returns -1 if all vertices are mapped, sets `min_cand` (0 if some vertex has no candidates)
+    int choose_branching(const homsearch_state<size_lim> &s, int &min_cand) const
+    {
+        int v = -1;
+        int max_deg = -1;
+        min_cand = H.size() + 1;
+
+        for (unsigned int i = 0; i < G.size(); i ++) {
+            int ccount = s.candidates[i].count();
+            if ((s.f[i] == -1) && (ccount <= min_cand)) {
+                if ((ccount < min_cand) || (G_degree[i] > max_deg)) {
+                    max_deg = G_degree[i];
+                    min_cand = ccount;
+                    v = i;
+                }
+            }
+        }
+        return v;
     }
 
    protected:
-    void add_res(const homsearch_state<size_lim> &s)
+    void add_res(const vector<int> &f)
     {
-        if (res_store && ((res_count < res_limit) || (res_limit == -1)))
-            res_list.push_back(s.f);
+        if ((res_count < res_limit) || (res_limit == -1)) {
+            if (res_store) {
+                lock_guard<mutex> lock(res_mutex);
+                res_list.push_back(f);
+            }
+            if (res_file)
+                write_res_file(f);
+        }
         res_count ++;
     }
+
+    void add_res(const homsearch_state<size_lim> &s)
+    {
+        add_res(s.f);
+    }
+
+    // distinct_images mode: branch on which vertices are fix-points (in the image),
+    // find one retraction for every determined image
+    void search_images(const homsearch_state<size_lim> &s);
 };
 
 template< size_t size_lim >
@@ -282,26 +673,20 @@ void homsearch_impl<size_lim>::search_state(const homsearch_state<size_lim> &s,
     // Valid state given?
     if (! s.state_valid)
         return;
-    
-    // Select branching vertex minimizing #candidates and
-    int v = -1;
-    int min_cand = H.size() + 1;
-    int max_deg = -1;
+
+    // Search node budget
+    node_count ++;
+    if (search_stopped())
+        return;
+
 
 //    cout << "\nsearch d = " << depth << " / " << max_depth << "\n";
 //    for (unsigned int i = 0; i < G.size(); i ++)
 //        cout << i << " " << s.f[i] << " " << s.candidates[i] << "\n";
 
-    for (unsigned int i = 0; i < G.size(); i ++) {
-        int ccount = s.candidates[i].count();
-	if ((s.f[i] == -1) && (ccount <= min_cand)) {
-	    if ((ccount < min_cand) || ((int)G[i].size() > max_deg)) {
-		max_deg = G[i].size();
-		min_cand = ccount;
-		v = i;
-	    }
-	}
-    }
+    // Select branching vertex minimizing #candidates and
+    int min_cand;
+    int v = choose_branching(s, min_cand);
 
     // Some vertex has no candidates
     if (min_cand == 0)
@@ -314,9 +699,16 @@ void homsearch_impl<size_lim>::search_state(const homsearch_state<size_lim> &s,
     }
 
     // Go over the candidates for v
-    for (unsigned int fv = 0; (fv < H.size()); fv ++) {
+    bool by_index = index_value_order();
+    vector<int> order;
+    if (! by_index)
+        order = value_order(s, v);
+    int values = by_index ? (int)H.size() : (int)order.size();
+    for (int i = 0; i < values; i++) {
+        int fv = by_index ? i : order[i];
+        if (by_index && (! s.candidates[v][fv])) continue;
         if ((res_limit >= 0) && (res_count >= res_limit)) break;
-	if (! s.candidates[v][fv]) continue;
+        if (search_stopped()) break;
 
 	// Create subsearch
         homsearch_state<size_lim> s2(s);
@@ -334,6 +726,146 @@ void homsearch_impl<size_lim>::search_state(const homsearch_state<size_lim> &s,
     }
 }
 
+template< size_t size_lim >
+bool homsearch_impl<size_lim>::search_first(const homsearch_state<size_lim> &s, vector<int> &res)
+{
+    if (! s.state_valid)
+        return false;
+    node_count ++;
+
+    int min_cand;
+    int v = choose_branching(s, min_cand);
+    if (min_cand == 0)
+        return false;
+    if (v == -1) {
+        res = s.f;
+        return true;
+    }
+
+    bool by_index = index_value_order();
+    vector<int> order;
+    if (! by_index)
+        order = value_order(s, v);
+    int values = by_index ? (int)H.size() : (int)order.size();
+    for (int i = 0; i < values; i++) {
+        int fv = by_index ? i : order[i];
+        if (by_index && (! s.candidates[v][fv])) continue;
+        if (search_stopped()) break;
+        homsearch_state<size_lim> s2(s);
+        if (s2.set_map(v, fv) && search_first(s2, res))
+            return true;
+    }
+    return false;
+}
+
+template< size_t size_lim >
+void homsearch_impl<size_lim>::search_images(const homsearch_state<size_lim> &s)
+{
+    if (! s.state_valid)
+        return;
+    node_count ++;
+    if (search_stopped())
+        return;
+    if ((! minimal_images) && (res_limit >= 0) && (res_count >= res_limit))
+        return;
+
+    // Fix-points so far (all in the image) and the undecided vertex (unmapped, may still be
+    // a fix-point) with the fewest candidates
+    bitset<size_lim> fixed;
+    int v = -1;
+    size_t min_cand = H.size() + 1;
+    for (unsigned int i = 0; i < G.size(); i++) {
+        if (s.f[i] == (int)i) {
+            fixed[i] = 1;
+        } else if (s.f[i] == -1) {
+            size_t c = s.candidates[i].count();
+            if (c == 0)
+                return;
+            if (s.candidates[i][i] && (c < min_cand)) {
+                v = i;
+                min_cand = c;
+            }
+        }
+    }
+
+    // Any image from here contains a found image: not minimal
+    if (minimal_images)
+        for (auto &img: found_images)
+            if ((img & ~fixed).none())
+                return;
+
+    // All vertices decided: any retraction from here has the image exactly `fixed`
+    if (v == -1) {
+        vector<int> res;
+        if (search_first(s, res)) {
+            found_images.push_back(fixed);
+            found_image_maps.push_back(res);
+            if (! minimal_images)
+                add_res(res);
+        }
+        return;
+    }
+
+    // v not in the image (first, finding small images early), then v a fix-point
+    homsearch_state<size_lim> s2(s);
+    s2.exclude_target(v);
+    search_images(s2);
+
+    homsearch_state<size_lim> s3(s);
+    if (s3.set_map(v, v))
+        search_images(s3);
+}
+
+template< size_t size_lim >
+vector<double> homsearch_impl<size_lim>::sample_log_counts(long long int samples, unsigned long long int seed,
+                                                           const vector<int> &f) const
+{
+    vector<double> res;
+    mt19937_64 rng(seed);
+    homsearch_state<size_lim> s0(this, &f);
+
+    for (long long int i = 0; i < samples; i++) {
+        // Random descent, branching as search_state does, uniformly among the consistent children.
+        // The estimate is the product of the numbers of consistent children along the path.
+        homsearch_state<size_lim> s(s0);
+        double log_est = 0.0;
+
+        while (true) {
+            int min_cand;
+            int v = s.state_valid ? choose_branching(s, min_cand) : -1;
+            if ((! s.state_valid) || (min_cand == 0)) {
+                log_est = - numeric_limits<double>::infinity();
+                break;
+            }
+            if (v == -1)
+                break;
+
+            // Reservoir-sample one of the consistent children
+            homsearch_state<size_lim> chosen(s);
+            long long int children = 0;
+            for (unsigned int fv = 0; fv < H.size(); fv ++) {
+                if (! s.candidates[v][fv]) continue;
+                homsearch_state<size_lim> s2(s);
+                if (! s2.set_map(v, fv))
+                    continue;
+                children ++;
+                if (uniform_int_distribution<long long int>(0, children - 1)(rng) == 0)
+                    chosen = s2;
+            }
+
+            if (children == 0) {
+                log_est = - numeric_limits<double>::infinity();
+                break;
+            }
+            log_est += log((double)children);
+            s = chosen;
+        }
+
+        res.push_back(log_est);
+    }
+    return res;
+}
+
 
 ///////////////////////////////////////////////////////////
 // Helper to create the right instance of homsearch_impl<>
@@ -341,4 +873,9 @@ void homsearch_impl<size_lim>::search_state(const homsearch_state<size_lim> &s,
 extern homsearch *new_homsearch(const vector<vector<int> > &G, const vector<vector<int> > &H,
               long long int res_limit, bool res_store, bool retract_mode, int max_depth=-1);
 
+// Same as new_homsearch, graphs given as CSR arrays (neighbors of v are indices[indptr[v] .. indptr[v+1]-1])
+extern homsearch *new_homsearch_csr(int nG, const int *G_indptr, const int *G_indices,
+              int nH, const int *H_indptr, const int *H_indices,
+              long long int res_limit, bool res_store, bool retract_mode, int max_depth=-1);
+
 #endif // _HOMSEARCH_LIB_H_
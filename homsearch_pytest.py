@@ -18,6 +18,12 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import os
+import math
+import tempfile
+
+import numpy
+
 import networkx as nx
 import homsearch
 
@@ -49,3 +55,395 @@ assert homsearch.find_homomorphisms(G1, G1, only_count=True) == 36
 R2 = homsearch.find_homomorphisms(G1, G1, only_count=False, partmap={'A':'E', 'E':'D', 'D':'A'})
 assert (len(R2) == 1) and (R2[0]['C'] == 'D') and (R2[0]['B'] == 'A')
 
+
+### Result files
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    fname = os.path.join(tmpdir, "res.bin")
+    assert homsearch.find_homomorphisms(G1, G1, results_file=fname) == 36
+    Gvs, Hvs, maps = homsearch.load_results(fname)
+    assert maps.shape == (36, 5)
+    R3 = [homsearch.fmap_to_graphmap(G1, G1, f) for f in maps]
+    assert R3 == homsearch.find_homomorphisms(G1, G1)
+    del maps
+
+    assert homsearch.find_retracts(G1, results_limit=2, results_file=fname) == 2
+    assert homsearch.load_results(fname)[2].shape == (2, 5)
+
+    # Truncated files are rejected
+    with open(fname, 'ab') as f:
+        f.write(b'\0')
+    try:
+        homsearch.load_results(fname)
+        assert False
+    except ValueError:
+        pass
+
+# Failed writes (disk full) are reported
+if os.path.exists('/dev/full'):
+    HF = homsearch.HomsearchInterface(homsearch.graph_to_csr(G1), homsearch.graph_to_csr(G1), -1, False, False)
+    HF.open_results_file('/dev/full', 2)
+    HF.search()
+    try:
+        HF.close_results_file()
+        assert False
+    except IOError:
+        pass
+
+### Result cache
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    cache = homsearch.HomsearchCache(tmpdir)
+    R4 = homsearch.find_homomorphisms(G1, G1, cache=cache)
+    assert R4 == homsearch.find_homomorphisms(G1, G1)
+    assert homsearch.find_homomorphisms(G1, G1, only_count=True, cache=cache) == 36
+    assert len(os.listdir(tmpdir)) == 1
+
+    # Relabelled graph hits the same entry
+    G1l = nx.relabel_nodes(G1, str.lower)
+    R5 = homsearch.find_homomorphisms(G1l, G1l, cache=cache)
+    assert len(os.listdir(tmpdir)) == 1
+    assert R5[0] == dict((v.lower(), u.lower()) for v, u in R4[0].items())
+
+    assert homsearch.find_retracts(G1, only_count=True, partmap={'B':'B'}, cache=cache) == 3
+    assert homsearch.find_retracts(G1, only_count=True, partmap={'B':'B'}, cache=cache) == 3
+    assert len(os.listdir(tmpdir)) == 2
+
+    cache.max_bytes = 0
+    cache.evict()
+    assert len(os.listdir(tmpdir)) == 0
+
+### Adjacency arrays
+
+A1 = nx.to_numpy_array(G1, nodelist=homsearch.graph_vertices(G1))
+C1 = homsearch.graph_to_csr(G1)
+assert C1[0].tolist() == [0, 4, 6, 9, 12, 14]
+assert homsearch.graph_to_adjlist(G1) == [[1, 2, 3, 4], [0, 2], [0, 1, 3], [0, 2, 4], [0, 3]]
+assert (homsearch.adjacency_to_csr(A1)[1] == C1[1]).all()
+
+assert homsearch.find_homomorphisms(A1, C1, only_count=True) == 36
+assert homsearch.find_retracts(C1, only_count=True, partmap={1: 1}) == 3
+# Any tuple is a CSR pair
+CL1 = (C1[0].tolist(), C1[1].tolist())
+assert homsearch.is_array_graph(CL1) and len(homsearch.graph_vertices(CL1)) == 5
+assert homsearch.find_homomorphisms(CL1, CL1, only_count=True) == 36
+for bad in (([1], [0]), ([0, 1], [0], [0])):
+    try:
+        homsearch.adjacency_to_csr(bad)
+        assert False
+    except ValueError:
+        pass
+R6 = homsearch.find_homomorphisms(C1, G1, partmap={0: 'E', 4: 'D', 3: 'A'})
+assert R6 == [dict((homsearch.graph_vertices(G1).index(v), u) for v, u in R2[0].items())]
+
+hs = homsearch.HomsearchInterface(C1, A1, -1, False, False)
+hs.search()
+assert hs.result_count() == 36
+
+# SciPy sparse matrices, explicit zeros are not edges
+if homsearch.scipy is not None:
+    S1 = homsearch.scipy.sparse.csr_matrix(A1)
+    rows, cols = numpy.nonzero(A1)
+    Z1 = homsearch.scipy.sparse.coo_matrix((numpy.concatenate((A1[rows, cols], [0, 0])),
+                                            (numpy.concatenate((rows, [1, 4])), numpy.concatenate((cols, [4, 1])))),
+                                           shape=A1.shape)
+    assert Z1.nnz == 16 and Z1.tocsr().nnz == 16
+    for S in (S1, S1.tocoo(), Z1, Z1.tocsr()):
+        assert (homsearch.adjacency_to_csr(S)[1] == C1[1]).all()
+        assert homsearch.find_homomorphisms(S, S, only_count=True) == 36
+        assert homsearch.find_homomorphisms(S, G1, partmap={0: 'E', 4: 'D', 3: 'A'}) == R6
+        assert homsearch.find_retracts(S, only_count=True, partmap={1: 1}) == 3
+
+### Job server
+
+import threading
+import homsearch_server
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    server = homsearch_server.HomsearchServer(os.path.join(tmpdir, "sock"), workers=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with homsearch_server.HomsearchClient(server.address) as client:
+            client.ping()
+            client.register_target("G1", G1)
+            J1 = client.search(G1, "G1")
+            assert J1.count == 36 and J1.complete and J1.maps == homsearch.find_homomorphisms(G1, G1)
+            J2, J3, J4 = client.search_many([
+                dict(G=G1, retract=True, only_count=True, partmap={'B': 'B'}),
+                dict(G=C1, H=A1, only_count=True),
+                dict(G=G1, H="G1", only_count=True, node_limit=3)])
+            assert J2.count == 3 and J3.count == 36
+            assert (not J4.complete) and J4.nodes > 3
+            try:
+                client.search(G1, "unknown")
+                assert False
+            except homsearch_server.HomsearchServerError:
+                pass
+            for bad in ([0, 1], [0] * 4 + [5], [0] * 4 + [-2]):
+                try:
+                    client.search(G1, "G1", partmap=bad)
+                    assert False
+                except homsearch_server.HomsearchServerError:
+                    pass
+            # Target engines are built once per size bucket and reused
+            client.register_target("K2", nx.complete_graph(2))
+            assert [client.search(nx.cycle_graph(k), "K2", only_count=True).count for k in (4, 5, 20, 21)] == \
+                [2, 0, 2, 0]
+            assert sorted(server.get_target("K2")[1]) == [16, 32]
+            P7, K4 = nx.path_graph(7), nx.complete_graph(4)
+            J5 = client.search(P7, K4)
+            assert J5.count == 4 * 3 ** 6 and J5.complete
+            assert sorted(map(sorted, (m.items() for m in J5.maps))) == \
+                sorted(map(sorted, (m.items() for m in homsearch.find_homomorphisms(P7, K4))))
+    finally:
+        server.shutdown()
+        thread.join()
+
+### asyncio
+
+import time
+import asyncio
+
+async def async_tests():
+    assert await homsearch.afind_homomorphisms(G1, G1, only_count=True) == 36
+    assert await homsearch.afind_homomorphisms(G1, G1, partmap={'A':'E', 'E':'D', 'D':'A'}) == R2
+    batches = [b async for b in homsearch.aiter_homomorphisms(G1, G1, results_limit=10)]
+    assert sum(len(b) for b in batches) == 10
+
+    # Astronomically many maps, cancellation must stop the search thread
+    C41, K4 = nx.cycle_graph(41), nx.complete_graph(4)
+    for only_count in (True, False):
+        try:
+            await asyncio.wait_for(homsearch.afind_homomorphisms(C41, K4, only_count=only_count), 0.1)
+            assert False
+        except asyncio.TimeoutError:
+            pass
+
+t0 = time.time()
+asyncio.run(async_tests())
+# asyncio.run waits for the executor threads
+assert time.time() - t0 < 10.0
+
+### Benchmark generators
+
+import homsearch_bench
+
+P = homsearch_bench.kneser_graph(5, 2)
+assert len(P) == 10 and all(len(a) == 3 for a in P)
+assert homsearch.find_retracts(homsearch.adjacency_to_csr(P), only_count=True) == 1
+assert sum(map(len, homsearch_bench.cube_like_graph(5, [31]))) == 32 * 6
+assert len(list(homsearch_bench.benchmarks(quick=True))) > 0
+
+### Approximate counting
+
+assert homsearch.count_homomorphisms(G1, G1) == 36
+E1 = homsearch.count_homomorphisms(G1, G1, approx=True, epsilon=0.05, seed=1)
+assert E1.converged and abs(E1.count - 36) <= 3 * E1.error
+E2 = homsearch.count_homomorphisms(G1, G1, approx=True, partmap={'B':'B'}, threads=2, seed=2)
+assert abs(E2.count - homsearch.find_homomorphisms(G1, G1, only_count=True, partmap={'B':'B'})) <= 3 * E2.error
+# 3-colorings of a cycle: 2^n + 2 (-1)^n
+E3 = homsearch.count_homomorphisms(nx.cycle_graph(200), nx.complete_graph(3), approx=True, seed=3)
+assert abs(E3.log_count - 200 * math.log(2)) < 0.2
+E4 = homsearch.count_homomorphisms(nx.complete_graph(4), nx.complete_graph(3), approx=True, max_samples=100)
+assert E4.count == 0 and E4.samples == 100
+
+### Distinct retract images
+
+assert homsearch.find_retracts(G1, only_count=True, distinct_images=True) == 6
+R7 = homsearch.find_retracts(G1, minimal_images=True)
+assert sorted(sorted(set(f.values())) for f in R7) == [['A', 'B', 'C'], ['A', 'C', 'D'], ['A', 'D', 'E']]
+# 4-cube retracts to its 32 edges (cores) and 2857 subgraphs in total
+Q4 = homsearch.adjacency_to_csr(homsearch_bench.cube_like_graph(4))
+assert homsearch.find_retracts(Q4, only_count=True, minimal_images=True) == 32
+R8 = homsearch.find_retracts(Q4, distinct_images=True)
+assert len(R8) == len(set(frozenset(f.values()) for f in R8)) == 2857
+# Branching on the image visits far fewer nodes than enumerating all the retractions
+HI3 = homsearch.HomsearchInterface(Q4, Q4, -1, False, True)
+HI3.search()
+HI4 = homsearch.HomsearchInterface(Q4, Q4, -1, False, True)
+HI4.set_image_mode(True)
+HI4.search()
+assert HI4.result_count() == 2857 and 4 * HI4.node_count() < HI3.node_count()
+# Results limit also holds for the minimal images (counted as enumerated)
+assert homsearch.find_retracts(G1, results_limit=1, only_count=True, minimal_images=True) == 1
+assert len(homsearch.find_retracts(G1, results_limit=1, minimal_images=True)) == 1
+
+### Target ladders
+
+K = [nx.complete_graph(k) for k in range(1, 7)]
+for strategy in ('bisect', 'descend', 'ascend'):
+    i, f = homsearch.find_threshold(G1, K, strategy=strategy)
+    assert i == 2 and len(set(f.values())) == 3
+    assert homsearch.find_threshold(nx.complete_graph(6), K[:4], strategy=strategy) == (None, None)
+    assert homsearch.find_threshold(C1, K, strategy=strategy, partmap={0: 5})[0] == 5
+
+### List homomorphisms
+
+assert homsearch.find_homomorphisms(G1, G1, only_count=True, lists={'A': ['A']}) == \
+    homsearch.find_homomorphisms(G1, G1, only_count=True, partmap={'A': 'A'})
+L1 = {'A': ['A', 'C'], 'B': 'BD', 'E': ['E']}
+R9 = homsearch.find_homomorphisms(G1, G1, lists=L1)
+assert len(R9) > 0 and all(f[v] in L1[v] for f in R9 for v in L1)
+assert len(R9) == sum(homsearch.find_homomorphisms(G1, G1, only_count=True, partmap={'A': a, 'B': b, 'E': 'E'})
+                      for a in L1['A'] for b in L1['B'])
+M1 = homsearch.lists_to_mask(G1, G1, L1)
+assert M1.shape == (5, 5) and M1.sum() == 2 + 2 + 1 + 5 + 5
+assert homsearch.find_homomorphisms(C1, C1, only_count=True, lists=M1) == len(R9)
+assert homsearch.find_homomorphisms(G1, G1, only_count=True, lists={'A': []}) == 0
+assert homsearch.find_retracts(G1, only_count=True, lists={'B': ['B']}) == 3
+with tempfile.TemporaryDirectory() as tmpdir:
+    cache = homsearch.HomsearchCache(tmpdir)
+    assert homsearch.find_homomorphisms(G1, G1, lists=L1, cache=cache) == R9
+    assert homsearch.find_homomorphisms(G1, G1, lists=L1, only_count=True, cache=cache) == len(R9)
+    assert len(os.listdir(tmpdir)) == 1
+
+### Incremental sessions
+
+S = homsearch.HomsearchSession(nx.cycle_graph(6), nx.complete_graph(3))
+f = S.find()
+assert S.last_action == 'searched' and f is not None
+S.remove_edge('G', 0, 1)
+assert S.find() == f and S.last_action == 'kept'
+S.add_edge('G', 0, 3)
+f = S.find()
+assert S.last_action in ('kept', 'repaired') and all(f[u] != f[v] for u, v in [(0, 3)] + [(i, i + 1) for i in range(1, 5)] + [(5, 0)])
+S.add_vertex('G', 'x')
+S.add_edge('G', 'x', 2)
+f = S.find()
+assert S.last_action == 'repaired' and f['x'] != f[2]
+f0 = f[0]
+S.remove_edge('H', f[0], 3 - f[0] - f[5])
+assert S.find() == f and S.last_action == 'kept'
+S.remove_edge('H', f[0], f[5])
+f = S.find()
+assert S.last_action == 'searched' and set(f.values()) == set(range(3)) - set([f0])
+# The engine of the graph version served the repairs and the full search, edits drop it
+assert S.engine is not None and S.engine.result_count() == 1
+S.add_edge('G', 'x', 'y')
+assert S.engine is None
+HI5 = homsearch.HomsearchInterface(C1, C1, 1, True, False)
+HI5.search()
+HI5.reset_results()
+assert HI5.result_count() == 0 and HI5.result_list() == []
+HI5.search_from([4, -1, -1, -1, -1])
+assert HI5.result_count() == 1 and HI5.result_list()[0][0] == 4
+S2 = homsearch.HomsearchSession(nx.complete_graph(4), nx.complete_graph(3))
+assert S2.find() is None and S2.last_action == 'searched'
+S2.add_edge('H', 0, 0)
+S2.remove_edge('H', 0, 0)
+S2.add_edge('G', 0, 0)
+assert S2.find() is None and S2.last_action == 'searched'
+assert S2.find() is None and S2.last_action == 'known'
+S2.remove_vertex('G', 0)
+assert S2.find() is not None and S2.last_action == 'searched'
+S2.remove_vertex('H', 2)
+assert S2.find() is None and S2.last_action == 'searched'
+
+### Directed graphs
+
+import itertools
+import random
+
+def brute_force_count(G, H, retract=False):
+    Gvs, Hvs = list(G.nodes()), list(H.nodes())
+    count = 0
+    for img in itertools.product(Hvs, repeat=len(Gvs)):
+        f = dict(zip(Gvs, img))
+        if all(H.has_edge(f[u], f[v]) for u, v in G.edges()) and \
+           ((not retract) or all(f[f[v]] == f[v] for v in Gvs)):
+            count += 1
+    return count
+
+DC3 = nx.cycle_graph(3, create_using=nx.DiGraph)
+TT3 = nx.DiGraph([(0, 1), (1, 2), (0, 2)])
+assert homsearch.find_homomorphisms(DC3, DC3, only_count=True) == 3
+assert homsearch.find_homomorphisms(nx.path_graph(3, create_using=nx.DiGraph), DC3, only_count=True) == 3
+assert homsearch.find_homomorphisms(TT3, DC3, only_count=True) == 0
+assert homsearch.find_homomorphisms(DC3, TT3, only_count=True) == 0
+assert homsearch.find_homomorphisms(TT3, TT3, only_count=True) == 1
+# Undirected graphs are symmetric digraphs
+assert homsearch.find_homomorphisms(DC3, nx.complete_graph(3), only_count=True) == 6
+assert homsearch.find_homomorphisms(nx.complete_graph(3), DC3, only_count=True) == 0
+assert homsearch.HomsearchInterface(homsearch.graph_to_csr(TT3), [[1], [0]], -1, False, False).is_directed()
+assert not homsearch.HomsearchInterface([[1], [0]], [[1], [0]], -1, False, False).is_directed()
+rnd = random.Random(37)
+for i in range(20):
+    DG = nx.gnp_random_graph(5, 0.3, seed=rnd.randrange(10 ** 6), directed=True)
+    DH = nx.gnp_random_graph(4, 0.5, seed=rnd.randrange(10 ** 6), directed=True)
+    DH.add_edges_from((v, v) for v in DH.nodes() if rnd.random() < 0.2)
+    assert homsearch.find_homomorphisms(DG, DH, only_count=True) == brute_force_count(DG, DH)
+    assert homsearch.find_retracts(DG, only_count=True) == brute_force_count(DG, DG, retract=True)
+    assert homsearch.find_homomorphisms(homsearch.graph_to_csr(DG), homsearch.graph_to_csr(DH),
+                                        only_count=True) == brute_force_count(DG, DH)
+# Loops map to loops
+GL = nx.Graph([(0, 0), (0, 1)])
+assert homsearch.find_homomorphisms(GL, nx.complete_graph(3), only_count=True) == 0
+assert homsearch.find_homomorphisms(GL, nx.Graph([(0, 0), (0, 1)]), only_count=True) == 2
+
+### Batched extension counting
+
+P1 = [{}, {'A': 'A'}, {'A': 'B', 'B': 'C'}, {'A': 'A', 'B': 'A'}]
+E1 = homsearch.count_extensions(G1, G1, P1)
+assert E1.tolist() == [homsearch.find_homomorphisms(G1, G1, only_count=True, partmap=pm) for pm in P1]
+assert homsearch.count_extensions(G1, G1, P1, exists=True).tolist() == [c > 0 for c in E1]
+C12 = nx.cycle_graph(12)
+PM = numpy.full((200, 12), -1, dtype=numpy.int32)
+PM[:, 0] = numpy.arange(200) % 3
+PM[:, 7] = (numpy.arange(200) // 3) % 3
+E2 = homsearch.count_extensions(C12, nx.complete_graph(3), PM, threads=4)
+assert E2.dtype == numpy.int64 and E2.shape == (200, )
+assert (E2 == homsearch.count_extensions(C12, nx.complete_graph(3), PM)).all()
+assert set(E2[:9]) == set(E2) and (E2[:9] > 0).all()
+HI = homsearch.HomsearchInterface([[1], [0]], [[1], [0]], -1, False, False)
+assert HI.search_many(numpy.zeros((0, 2), dtype=numpy.int32)).shape == (0, )
+assert HI.search_many([[0, 0], [0, 1], [-1, -1]], exists=True).tolist() == [False, True, True]
+
+### Homomorphism profiles
+
+PAT = [nx.path_graph(k) for k in range(1, 6)] + [nx.cycle_graph(k) for k in range(3, 8)] + \
+      [nx.star_graph(3), nx.complete_graph(4), nx.disjoint_union(nx.cycle_graph(4), nx.path_graph(3)),
+       nx.complete_graph(3).to_directed(), nx.Graph([(0, 0), (0, 1)])]
+for HP in (nx.petersen_graph(), G1, nx.Graph([(0, 0), (0, 1), (1, 2)])):
+    HP1 = homsearch.hom_profile(PAT, HP, threads=2)
+    assert HP1.dtype == numpy.int64
+    assert HP1.tolist() == [homsearch.find_homomorphisms(F, HP, only_count=True) for F in PAT]
+assert homsearch.hom_profile([nx.Graph()], G1).tolist() == [1]
+HP2 = homsearch.hom_profile([nx.path_graph(20), nx.cycle_graph(20)], nx.complete_graph(100))
+assert HP2.dtype == object and HP2.tolist() == [100 * 99 ** 19, 99 ** 20 + 99]
+HP3 = homsearch.hom_profile([nx.cycle_graph(k) for k in (7, 8, 12)], nx.cycle_graph(20000))
+assert HP3.tolist() == [0, 20000 * math.comb(8, 4), 20000 * math.comb(12, 6)]
+K3I = nx.complete_graph(3)
+K3I.add_nodes_from(range(3, 600))
+assert homsearch.hom_profile([nx.cycle_graph(3)], nx.empty_graph(3)).tolist() == [0]
+assert homsearch.hom_profile([nx.cycle_graph(3), nx.cycle_graph(4)], K3I).tolist() == [6, 18]
+
+### Value orders
+
+for order in ('index', 'lcv', 'degree', 'n2'):
+    for seed in (None, 42):
+        assert homsearch.find_homomorphisms(G1, G1, only_count=True, value_order=order, value_seed=seed) == \
+            homsearch.find_homomorphisms(G1, G1, only_count=True)
+        assert homsearch.find_retracts(G1, only_count=True, value_order=order, value_seed=seed) == 6
+        C7 = nx.cycle_graph(7)
+        R10 = homsearch.find_homomorphisms(C7, nx.complete_graph(3), results_limit=5, value_order=order,
+                                           value_seed=seed)
+        assert len(R10) == 5 and all(f[u] != f[v] for f in R10 for u, v in C7.edges())
+        assert R10 == homsearch.find_homomorphisms(C7, nx.complete_graph(3), results_limit=5, value_order=order,
+                                                   value_seed=seed)
+with tempfile.TemporaryDirectory() as tmpdir:
+    cache = homsearch.HomsearchCache(tmpdir)
+    K2, P3 = nx.path_graph(2), nx.path_graph(3)
+    assert homsearch.find_homomorphisms(K2, P3, results_limit=1, cache=cache) == [{0: 0, 1: 1}]
+    for _ in range(2):
+        assert homsearch.find_homomorphisms(K2, P3, results_limit=1, cache=cache, value_order='degree') == \
+            homsearch.find_homomorphisms(K2, P3, results_limit=1, value_order='degree') == [{0: 1, 1: 0}]
+# Hints stay first
+HI2 = homsearch.HomsearchInterface([[1], [0]], [[1, 2], [0, 2], [0, 1]], 1, True, False)
+HI2.set_value_order('lcv', 7)
+HI2.set_hint([2, 1])
+HI2.search()
+assert HI2.result_list() == [[2, 1]]
+D1 = nx.DiGraph([(0, 1), (0, 2), (1, 2), (2, 3)])
+assert homsearch.count_extensions(DC3, D1, [{}], value_order='degree').tolist() == [0]
+assert homsearch.find_homomorphisms(TT3, D1, only_count=True, value_order='n2') == brute_force_count(TT3, D1)
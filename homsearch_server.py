@@ -0,0 +1,441 @@
+# Copyright (c) 2015 Tomas Gavenciak <gavento@ucw.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Long-lived homsearch job server and its client.
+
+Run with `python -m homsearch_server --unix PATH` or `python -m homsearch_server --tcp HOST:PORT`.
+
+The protocol is newline-delimited JSON in both directions. Requests:
+
+    {"id": 1, "op": "ping"}
+    {"id": 2, "op": "target", "name": "K3", "H": GRAPH}
+    {"id": 3, "op": "search", "G": GRAPH, "H": GRAPH or target name, "mode": "hom" or "retract",
+     "results_limit": -1, "only_count": false, "max_depth": -1, "partmap": [-1, 2, ...], "node_limit": -1}
+
+where GRAPH is either {"adj": neighbor lists} or the binary form
+{"n": n, "indptr": base64, "indices": base64} of little-endian int32 CSR arrays.
+Retract searches ignore "H". Requests on one connection are run concurrently on the worker pool,
+every response carries the request id: zero or more {"id", "results": [maps]} batches followed by
+{"id", "done": true, "count", "nodes", "complete"}, or {"id", "error": message}.
+"""
+
+import os
+import sys
+import json
+import base64
+import socket
+import argparse
+import itertools
+import threading
+import collections
+import socketserver
+import concurrent.futures
+
+import numpy
+
+import homsearch
+from homsearch_interface import HomsearchInterface, adjacency_to_csr, SIZE_LIMITS
+
+
+# Number of maps per streamed "results" message
+RESULT_BATCH = 1024
+
+# Seconds between collecting the maps found by a running search
+RESULT_POLL_INTERVAL = 0.05
+
+
+class HomsearchServerError(Exception):
+    "Error reported by the server for a request"
+    pass
+
+
+#############################
+# Graph encoding
+
+def encode_graph(G):
+    "Takes a graph (anything accepted by `homsearch.graph_to_csr`) and returns its binary protocol form"
+
+    indptr, indices = homsearch.graph_to_csr(G)
+    return {'n': len(indptr) - 1,
+            'indptr': base64.b64encode(indptr.astype('<i4').tobytes()).decode('ascii'),
+            'indices': base64.b64encode(indices.astype('<i4').tobytes()).decode('ascii')}
+
+
+def decode_graph(spec):
+    "Takes a protocol graph and returns its CSR adjacency `(indptr, indices)`"
+
+    if 'adj' in spec:
+        return adjacency_to_csr(spec['adj'])
+    indptr = numpy.frombuffer(base64.b64decode(spec['indptr']), dtype='<i4')
+    indices = numpy.frombuffer(base64.b64decode(spec['indices']), dtype='<i4')
+    if len(indptr) != spec['n'] + 1:
+        raise ValueError("indptr length does not match n")
+    return adjacency_to_csr((indptr, indices))
+
+
+#############################
+# Server
+
+class _Handler(socketserver.StreamRequestHandler):
+    "Reads requests from one connection and submits them to the worker pool"
+
+    def handle(self):
+        lock = threading.Lock()
+
+        def send(msg):
+            data = json.dumps(msg).encode('ascii') + b'\n'
+            with lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+
+        pending = []
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            pending = [p for p in pending if not p.done()]
+            try:
+                req = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                send({'id': None, 'error': 'Invalid request: %s' % (e, )})
+                continue
+            pending.append(self.server.homsearch.pool.submit(self.server.homsearch.run_job, req, send))
+
+        # Finish running jobs before closing the connection
+        for p in pending:
+            p.result()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class HomsearchServer(object):
+    """
+    Job server answering search requests on `address` (a Unix socket path or a `(host, port)` pair).
+
+    Jobs run on a pool of `workers` threads (the searches release the GIL), each limited
+    to `node_limit` search nodes (-1 for unlimited) unless the request asks for less.
+    Up to `max_targets` named targets are kept preprocessed (for every size bucket used), least recently used
+    are dropped; a job to a named target only builds the G side of the search.
+    Found maps are streamed to the client in batches while the search runs.
+    """
+
+    def __init__(self, address, workers=None, node_limit=-1, max_targets=256):
+        self.node_limit = node_limit
+        self.max_targets = max_targets
+        self.targets = collections.OrderedDict()
+        self.targets_lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count() or 1)
+
+        if isinstance(address, str):
+            self.server = _UnixServer(address, _Handler)
+        else:
+            self.server = _TCPServer(tuple(address), _Handler)
+        self.server.homsearch = self
+        self.address = self.server.server_address
+
+    def serve_forever(self):
+        "Serve requests until `shutdown` is called"
+        self.server.serve_forever()
+
+    def shutdown(self):
+        "Stop serving, wait for running jobs and close the socket"
+        self.server.shutdown()
+        self.pool.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def add_target(self, name, H):
+        "Decode and keep target `H` (protocol form) under `name`, its engines are built on first use"
+
+        H = decode_graph(H)
+        with self.targets_lock:
+            self.targets[name] = (H, {})
+            self.targets.move_to_end(name)
+            while len(self.targets) > self.max_targets:
+                self.targets.popitem(last=False)
+
+    def get_target(self, name):
+        "Return the decoded target `name` and its preprocessed engines by size bucket"
+
+        with self.targets_lock:
+            if name not in self.targets:
+                raise KeyError("Unknown target %r" % (name, ))
+            self.targets.move_to_end(name)
+            return self.targets[name]
+
+    def target_search(self, G, name, results_limit, res_store, max_depth):
+        "Return a `HomsearchInterface` from `G` to the target `name`, reusing its preprocessed engine"
+
+        H, engines = self.get_target(name)
+        size = max(len(G[0]), len(H[0])) - 1
+        bucket = min([b for b in SIZE_LIMITS if b >= size] or [None])
+        if bucket is None:
+            return HomsearchInterface(G, H, results_limit, res_store, False, max_depth=max_depth)
+        with self.targets_lock:
+            engine = engines.get(bucket)
+        if engine is None:
+            # Engine of the bucket with an edgeless G, only its H side is used
+            engine = HomsearchInterface([[]] * size, H, -1, False, False)
+            with self.targets_lock:
+                engine = engines.setdefault(bucket, engine)
+        return engine.for_graph(G, results_limit, res_store, max_depth)
+
+    def job_node_limit(self, req):
+        "The node budget of request `req` (capped by the server budget)"
+
+        limits = [l for l in (req.get('node_limit', -1), self.node_limit) if l >= 0]
+        return min(limits) if limits else -1
+
+    def run_job(self, req, send):
+        "Run request `req`, pass response messages to `send`"
+
+        rid = req.get('id')
+        try:
+            op = req.get('op', 'search')
+            if op == 'ping':
+                send({'id': rid, 'done': True})
+            elif op == 'target':
+                self.add_target(req['name'], req['H'])
+                send({'id': rid, 'done': True})
+            elif op == 'search':
+                self.run_search(rid, req, send)
+            else:
+                raise ValueError("Unknown op %r" % (op, ))
+        except Exception as e:
+            try:
+                send({'id': rid, 'error': '%s: %s' % (type(e).__name__, e)})
+            except (IOError, OSError):
+                pass
+
+    def run_search(self, rid, req, send):
+        retract_mode = (req.get('mode', 'hom') == 'retract')
+        only_count = req.get('only_count', False)
+        G = decode_graph(req['G'])
+        if retract_mode:
+            H = G
+        elif isinstance(req['H'], str):
+            H = self.get_target(req['H'])[0]
+        else:
+            H = decode_graph(req['H'])
+
+        f = req.get('partmap')
+        if f is not None:
+            nG, nH = len(G[0]) - 1, len(H[0]) - 1
+            if not (isinstance(f, list) and len(f) == nG and
+                    all(isinstance(fv, int) and -1 <= fv < nH for fv in f)):
+                raise ValueError("partmap must be a list of |G| = %d ints in -1 .. %d" % (nG, nH - 1))
+
+        if (not retract_mode) and isinstance(req['H'], str):
+            hs = self.target_search(G, req['H'], req.get('results_limit', -1), not only_count,
+                                    req.get('max_depth', -1))
+        else:
+            hs = HomsearchInterface(G, H, req.get('results_limit', -1), not only_count, retract_mode,
+                                    max_depth=req.get('max_depth', -1))
+        hs.set_node_limit(self.job_node_limit(req))
+
+        def search():
+            if f is None:
+                hs.search()
+            else:
+                hs.search_from(f)
+
+        if only_count:
+            search()
+        else:
+            # Run the search on a helper thread (releasing the GIL), send the maps found so far
+            searching = threading.Thread(target=search, daemon=True)
+            searching.start()
+            try:
+                while True:
+                    searching.join(RESULT_POLL_INTERVAL)
+                    running = searching.is_alive()
+                    res = hs.take_results()
+                    for i in range(0, len(res), RESULT_BATCH):
+                        send({'id': rid, 'results': res[i:i + RESULT_BATCH]})
+                    if not running:
+                        break
+            except BaseException:
+                # Client gone, stop the search
+                hs.cancel()
+                searching.join()
+                raise
+
+        send({'id': rid, 'done': True, 'count': hs.result_count(), 'nodes': hs.node_count(),
+              'complete': not hs.node_limit_reached()})
+
+
+#############################
+# Client
+
+JobResult = collections.namedtuple('JobResult', ['count', 'maps', 'nodes', 'complete'])
+
+
+class HomsearchClient(object):
+    """
+    Client for `HomsearchServer` at `address` (a Unix socket path or a `(host, port)` pair).
+    Graphs may be Sage or NetworkX graphs or adjacency arrays, maps are returned relabelled to their vertices.
+    """
+
+    def __init__(self, address):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.rfile = self.sock.makefile('rb')
+        self.ids = itertools.count()
+        self.inbox = collections.defaultdict(list)
+        self.targets = {}
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, req):
+        "Send request `req` (dict), returns its id"
+
+        req = dict(req, id=next(self.ids))
+        self.sock.sendall(json.dumps(req).encode('ascii') + b'\n')
+        return req['id']
+
+    def receive(self, rid):
+        "Collect the response messages for request `rid`, returns `(result maps, final message)`"
+
+        maps = []
+        while True:
+            if self.inbox[rid]:
+                msg = self.inbox[rid].pop(0)
+            else:
+                line = self.rfile.readline()
+                if not line:
+                    raise HomsearchServerError("Connection closed by server")
+                msg = json.loads(line.decode('utf-8'))
+                if msg.get('id') != rid:
+                    self.inbox[msg.get('id')].append(msg)
+                    continue
+            if 'error' in msg:
+                del self.inbox[rid]
+                raise HomsearchServerError(msg['error'])
+            if 'results' in msg:
+                maps.extend(msg['results'])
+            if msg.get('done'):
+                del self.inbox[rid]
+                return (maps, msg)
+
+    def ping(self):
+        self.receive(self.send({'op': 'ping'}))
+
+    def register_target(self, name, H):
+        "Send target `H` to be kept by the server under `name`"
+
+        self.receive(self.send({'op': 'target', 'name': name, 'H': encode_graph(H)}))
+        self.targets[name] = H
+
+    def _search_request(self, G, H, retract, results_limit, only_count, max_depth, partmap, node_limit):
+        # Targets registered by other clients are known only by their numbering
+        Ht = G if retract else (self.targets.get(H) if isinstance(H, str) else H)
+        req = {'op': 'search', 'G': encode_graph(G), 'mode': 'retract' if retract else 'hom',
+               'results_limit': results_limit, 'only_count': only_count, 'max_depth': max_depth,
+               'node_limit': node_limit}
+        if not retract:
+            req['H'] = H if isinstance(H, str) else encode_graph(H)
+        if isinstance(partmap, dict) and Ht is not None:
+            req['partmap'] = homsearch.graphmap_to_fmap(G, Ht, partmap)
+        elif isinstance(partmap, dict):
+            req['partmap'] = [partmap.get(v, -1) for v in homsearch.graph_vertices(G)]
+        elif partmap is not None:
+            req['partmap'] = list(partmap)
+        return (self.send(req), G, Ht)
+
+    def _search_result(self, rid, G, Ht):
+        maps, msg = self.receive(rid)
+        if Ht is None:
+            Gvs = homsearch.graph_vertices(G)
+            maps = [dict((Gvs[v], (f[v] if f[v] >= 0 else None)) for v in range(len(f))) for f in maps]
+        else:
+            maps = [homsearch.fmap_to_graphmap(G, Ht, f) for f in maps]
+        return JobResult(msg['count'], maps, msg['nodes'], msg['complete'])
+
+    def search(self, G, H=None, retract=False, results_limit=-1, only_count=False, max_depth=-1,
+               partmap=None, node_limit=-1):
+        """
+        Run a `find_homomorphisms` (or `find_retracts` with `retract`) query on the server,
+        `H` may be a name given to `register_target`. Returns a `JobResult`; `complete` is false
+        when the job ran out of its node budget.
+        """
+
+        return self._search_result(*self._search_request(G, H, retract, results_limit, only_count,
+                                                         max_depth, partmap, node_limit))
+
+    def search_many(self, queries):
+        """
+        Run many searches pipelined on one connection. `queries` is an iterable of dicts
+        of `search` arguments, returns the list of `JobResult`s in the same order.
+        """
+
+        sent = [self._search_request(q['G'], q.get('H'), q.get('retract', False), q.get('results_limit', -1),
+                                     q.get('only_count', False), q.get('max_depth', -1), q.get('partmap'),
+                                     q.get('node_limit', -1))
+                for q in queries]
+        return [self._search_result(*s) for s in sent]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Homsearch job server")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--unix', metavar='PATH', help="Listen on Unix socket PATH")
+    group.add_argument('--tcp', metavar='HOST:PORT', help="Listen on TCP address HOST:PORT")
+    parser.add_argument('--workers', type=int, default=None, help="Worker threads (default: CPU count)")
+    parser.add_argument('--node-limit', type=int, default=-1, help="Search node budget per job (default: unlimited)")
+    parser.add_argument('--max-targets', type=int, default=256, help="Number of named targets to keep")
+    args = parser.parse_args(argv)
+
+    if args.unix:
+        address = args.unix
+    else:
+        host, port = args.tcp.rsplit(':', 1)
+        address = (host, int(port))
+
+    server = HomsearchServer(address, workers=args.workers, node_limit=args.node_limit,
+                             max_targets=args.max_targets)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -49,5 +49,78 @@ int main()
 
     delete h;
 
+    // Retracts by distinct and minimal image
+    h = new_homsearch(G, G, -1, true, true, -1);
+    h->distinct_images = true;
+    h->search(0);
+    assert(h->res_count == 6);
+    delete h;
+
+    h = new_homsearch(G, G, -1, true, true, -1);
+    h->distinct_images = true;
+    h->minimal_images = true;
+    h->search(0);
+    assert(h->res_count == 3);
+    delete h;
+
+    // Directed 3-cycle to itself (rotations only)
+    vector<vector<int> > D;
+    const int d0[] = {1}; push_array(D, d0);
+    const int d1[] = {2}; push_array(D, d1);
+    const int d2[] = {0}; push_array(D, d2);
+    h = new_homsearch(D, D, -1, true, false, -1);
+    assert(h->directed);
+    h->search(0);
+    assert(h->res_count == 3);
+    delete h;
+
+    // Path on 1100 vertices (largest size bucket) to K_3, with all value orders
+    vector<vector<int> > P(1100), K3(3);
+    for (int i = 0; i + 1 < 1100; i++) {
+        P[i].push_back(i + 1);
+        P[i + 1].push_back(i);
+    }
+    for (int i = 0; i < 3; i++)
+        for (int j = 0; j < 3; j++)
+            if (i != j)
+                K3[i].push_back(j);
+    for (int order = VALUE_ORDER_INDEX; order <= VALUE_ORDER_N2; order++) {
+        h = new_homsearch(P, K3, 1, true, false, -1);
+        h->value_order_mode = order;
+        h->value_random_ties = (order == VALUE_ORDER_LCV);
+        h->search(0);
+        assert(h->res_count == 1);
+        assert(h->node_count == 1101);
+        delete h;
+    }
+
+    // Maps of K_3 to itself come in index order, with or without building the value order
+    vector<vector<int> > by_index;
+    for (int order = VALUE_ORDER_INDEX; order <= VALUE_ORDER_DEGREE; order++) {
+        h = new_homsearch(K3, K3, -1, true, false, -1);
+        h->value_order_mode = order;
+        h->search(0);
+        assert(h->res_count == 6);
+        if (order == VALUE_ORDER_INDEX)
+            by_index = h->res_list;
+        assert(h->res_list == by_index);
+        delete h;
+    }
+    assert(by_index.front() == vector<int>({0, 1, 2}) && by_index.back() == vector<int>({2, 1, 0}));
+
+    // Searches from other graphs to the preprocessed K_3 (in the size bucket 16)
+    h = new_homsearch(vector<vector<int> >(16), K3, -1, false, false, -1);
+    vector<vector<int> > C5(5);
+    for (int i = 0; i < 5; i++) {
+        C5[i].push_back((i + 1) % 5);
+        C5[(i + 1) % 5].push_back(i);
+    }
+    homsearch *h2 = h->new_for_graph(C5, -1, true);
+    h2->search(0);
+    assert(h2->res_count == 30 && h2->res_list.size() == 30);
+    delete h2;
+    assert(h->new_for_graph(vector<vector<int> >(17), -1, false) == NULL);
+    delete h;
+
     return 0;
 }
@@ -6,7 +6,8 @@ extension = Extension(
            "homsearch_interface",                 # module name
            sources=["homsearch_interface.pyx", "homsearch_lib.cpp"],  # source files
            language="c++",             # generate C++ code
-           extra_compile_args=['-std=c++11'],
+           extra_compile_args=['-std=c++11', '-pthread'],
+           extra_link_args=['-pthread'],
            )
     
 